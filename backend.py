@@ -2,146 +2,228 @@ from PyQt6 import QtWidgets
 from PyQt6.QtCore import QSettings
 
 import sys
+import threading
 import time
-import psycopg2
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPDigestAuth
 
 import material3_components as mt3
+import parameters
+import storage
 
 # -------------
 # Base de Datos
 # -------------
-def create_db(db_name: str, db_password: str):
-    connection = psycopg2.connect(user='postgres', 
-                                password=db_password, 
-                                host='localhost', 
-                                port='5432', 
-                                database=db_name)
-    cursor = connection.cursor()
+# Selected from settings.ini before the first call, see storage.STORAGES
+storage_kind = 'postgres'
+
+_storages = {}
+_storages_lock = threading.Lock()
 
-    cursor.execute("""CREATE TABLE IF NOT EXISTS cameras (
-                    id serial PRIMARY KEY,
-                    nombre VARCHAR(128) UNIQUE NOT NULL,
-                    ip_camera VARCHAR(15) UNIQUE NOT NULL,
-                    username VARCHAR(128) NOT NULL,
-                    password VARCHAR(128) NOT NULL
-                    )""")
-    connection.commit()
+def get_storage(db_name: str, db_password: str) -> storage.Storage:
+    """Returns the shared storage of a database, opening it on first use"""
+    key = (storage_kind, db_name, db_password)
+    with _storages_lock:
+        current_storage = _storages.get(key)
+        if current_storage is None:
+            current_storage = storage.open_storage(storage_kind, db_name, db_password,
+                f'{sys.path[0]}/{db_name}.sqlite3')
+            _storages[key] = current_storage
+        return current_storage
 
-    cursor.execute('SELECT * FROM cameras')
-    ip_cameras_value = cursor.fetchall()
-    connection.close()
 
-    return ip_cameras_value
+def close_storages():
+    with _storages_lock:
+        for current_storage in _storages.values():
+            current_storage.close()
+        _storages.clear()
+
+
+def create_db(db_name: str, db_password: str):
+    return get_storage(db_name, db_password).create()
 
 
 def add_db(camera_data, db_name: str, db_password: str):
-    name_value = camera_data['name']
-    ip_value = camera_data['ip']
-    username_value = camera_data['username']
-    password_value = camera_data['password']
-
-    connection = psycopg2.connect(user='postgres', 
-                                password=db_password, 
-                                host='localhost', 
-                                port='5432', 
-                                database=db_name)
-    cursor = connection.cursor()
-    insert_query = f"""INSERT INTO cameras (NOMBRE, IP_CAMERA, USERNAME, PASSWORD) 
-                    VALUES ('{name_value}', '{ip_value}', '{username_value}', '{password_value}')"""
-    cursor.execute(insert_query)
-    connection.commit()
-    cursor.execute('SELECT * FROM cameras')
-    ip_cameras_value = cursor.fetchall()
-    connection.close()
-    
-    return ip_cameras_value
+    """Returns the inserted camera row"""
+    return get_storage(db_name, db_password).add_camera(camera_data)
 
 
 def get_db(camera_name, db_name: str, db_password: str):
-    connection = psycopg2.connect(user='postgres', 
-                                password=db_password, 
-                                host='localhost', 
-                                port='5432', 
-                                database=db_name)
-    cursor = connection.cursor()
-    cursor.execute(f"SELECT * FROM cameras WHERE nombre='{camera_name}'")
-    data = cursor.fetchall()
-    connection.close()
-    
-    return data
+    return get_storage(db_name, db_password).get_camera(camera_name)
 
 
 def edit_db(camera_id, camera_data, db_name: str, db_password: str):
-    name_value = camera_data['name']
-    ip_value = camera_data['ip']
-    username_value = camera_data['username']
-    password_value = camera_data['password']
-
-    connection = psycopg2.connect(user='postgres', 
-                                password=db_password, 
-                                host='localhost', 
-                                port='5432', 
-                                database=db_name)
-    cursor = connection.cursor()
-    update_query = f"""UPDATE cameras 
-                    SET (nombre, ip_camera, username, password)
-                    = ('{name_value}', '{ip_value}', '{username_value}', '{password_value}') 
-                    WHERE id = '{camera_id}' """
-    cursor.execute(update_query)
-    connection.commit()
-    cursor.execute('SELECT * FROM cameras')
-    ip_cameras_value = cursor.fetchall()
-    connection.close()
-
-    return ip_cameras_value
+    """Returns the updated camera row, None if the camera no longer exists"""
+    return get_storage(db_name, db_password).edit_camera(camera_id, camera_data)
 
 
 def delete_db(camera_name, db_name: str, db_password: str):
-    connection = psycopg2.connect(user='postgres', 
-                                password=db_password, 
-                                host='localhost', 
-                                port='5432', 
-                                database=db_name)
-    cursor = connection.cursor()
-    delete_query = f"DELETE FROM cameras WHERE nombre='{camera_name}'"
-    cursor.execute(delete_query)
-    connection.commit()
-    cursor.execute('SELECT * FROM cameras')
-    ip_cameras_value = cursor.fetchall()
-    connection.close()
-
-    return ip_cameras_value
+    """Returns the ids of the deleted cameras"""
+    return get_storage(db_name, db_password).delete_camera(camera_name)
+
+
+def get_presets_db(camera_id, db_name: str, db_password: str):
+    return get_storage(db_name, db_password).get_presets(camera_id)
+
+
+def save_preset_db(camera_id, preset_name: str, pan: float, tilt: float, zoom: float, db_name: str, db_password: str):
+    """Stores a preset, replacing the position of an existing one with the same name"""
+    get_storage(db_name, db_password).save_preset(camera_id, preset_name, pan, tilt, zoom)
 
 
 # ------
 # Cámara
 # ------
+class CameraUnavailable(requests.ConnectionError):
+    """Raised without touching the network while the circuit breaker of a camera is open"""
+
+
+class CircuitBreaker:
+    """Opens after failure_threshold consecutive failures so calls fail fast.
+    While open, probe() is retried in the background every retry_interval seconds
+    and the breaker closes again as soon as it succeeds"""
+    def __init__(self, probe, failure_threshold: int = 3, retry_interval: float = 5.0):
+        self._lock = threading.Lock()
+        self._probe = probe
+        self.failure_threshold = failure_threshold
+        self.retry_interval = retry_interval
+        self.failures = 0
+        self.is_open = False
+
+    def allow(self) -> bool:
+        return not self.is_open
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.is_open = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.is_open or self.failures < self.failure_threshold:
+                return
+            self.is_open = True
+        threading.Thread(target=self._probe_loop, daemon=True).start()
+
+    def _probe_loop(self):
+        while self.is_open:
+            time.sleep(self.retry_interval)
+            try:
+                self._probe()
+            except Exception:
+                continue
+            self.record_success()
+
+
+class SharedDigestAuth(HTTPDigestAuth):
+    """HTTPDigestAuth keeps the challenge per thread, so every new worker thread paid its own 401.
+    Here the challenge, nonce and nonce count are shared by all the threads of a client"""
+    def __init__(self, username: str, password: str):
+        super().__init__(username, password)
+        self._lock = threading.Lock()
+        self._challenge = {}
+        self._last_nonce = ''
+        self._nonce_count = 0
+
+    def init_per_thread_state(self):
+        super().init_per_thread_state()
+        # A nonce seen by any thread lets this one skip the 401
+        self._thread_local.last_nonce = self._last_nonce
+
+    def build_digest_header(self, method, url):
+        with self._lock:
+            local = self._thread_local
+            if local.chal and local.chal is not getattr(local, 'shared_chal', None):
+                # handle_401 stored a new challenge in this thread
+                self._challenge = local.chal
+            local.chal = local.shared_chal = self._challenge
+            local.last_nonce = self._last_nonce
+            local.nonce_count = self._nonce_count
+            header = super().build_digest_header(method, url)
+            self._last_nonce = local.last_nonce
+            self._nonce_count = local.nonce_count
+            return header
+
+
+class VapixClient:
+    """HTTP client for one camera. Connections are kept alive in a pool and the digest
+    nonce of the last challenge is reused by every thread, so most calls skip the 401 round trip.
+    Every request runs under a (connect, read) timeout and behind a circuit breaker"""
+    def __init__(self, ipaddress: str, username: str, password: str, pool_size: int = 4,
+                 timeout: tuple = (2, 3)):
+        self.base_url = f'http://{ipaddress}'
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.auth = SharedDigestAuth(username, password)
+        self.breaker = CircuitBreaker(self.probe)
+
+    def post(self, path: str, data: dict, timeout=None):
+        if not self.breaker.allow():
+            raise CameraUnavailable(f'{self.base_url} is not responding')
+        try:
+            response = self.session.post(f'{self.base_url}{path}', data = data, timeout = timeout or self.timeout)
+        except requests.RequestException:
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        return response
+
+    def probe(self):
+        """Cheap request used by the circuit breaker to find out if the camera is back"""
+        self.session.post(f'{self.base_url}/axis-cgi/com/ptz.cgi', data = { 'query': 'position' },
+            timeout = self.timeout).raise_for_status()
+
+    def close(self):
+        self.session.close()
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_client(ipaddress: str, username: str, password: str) -> VapixClient:
+    """Returns the shared client of a camera, creating it on first use"""
+    key = (ipaddress, username, password)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = VapixClient(ipaddress, username, password)
+            _clients[key] = client
+    return client
+
+
+def parse_response(text: str, keys=None) -> dict:
+    """Parses name=value lines, numbers are returned as float"""
+    result = {}
+    for line in text.splitlines():
+        if '=' not in line:
+            continue
+        (name, var) = line.split('=', 1)
+        name = name.strip()
+        if keys is not None and name not in keys:
+            continue
+        try:
+            result[name] = float(var)
+        except ValueError:
+            result[name] = var
+    return result
+
+
 def get_PTZ(ipaddress: str, username: str, password: str):
     data = { 'query': 'position' }
-    result = {}
-    camera_url = f'http://{ipaddress}/axis-cgi/com/ptz.cgi'
     timeout = 3 # seconds
 
     try:
-        camera_res = requests.post(camera_url, data = data, auth = HTTPDigestAuth(username, password))
-    
-        for line in camera_res.text.splitlines():
-            (name, var) = line.split('=', 2)
-            try:
-                result[name.strip()] = float(var)
-            except ValueError:
-                result[name.strip()] = var
-        
-        return result
+        camera_res = get_client(ipaddress, username, password).post('/axis-cgi/com/ptz.cgi', data, timeout)
+        return parse_response(camera_res.text)
     except:
         return 'error'
 
 
 def set_PTZ(pan_data: str, tilt_data: str, zoom_data: str, ipaddress: str, username: str, password: str):
-        camera_url = f'http://{ipaddress}/axis-cgi/com/ptz.cgi'
-
         data = {
             'camera': 1,
             'imagerotation': 0,
@@ -153,53 +235,151 @@ def set_PTZ(pan_data: str, tilt_data: str, zoom_data: str, ipaddress: str, usern
         }
 
         try:
-            camera_res = requests.post(camera_url, data = data, auth = HTTPDigestAuth(username, password))
+            get_client(ipaddress, username, password).post('/axis-cgi/com/ptz.cgi', data)
             return 'ok'
         except:
             return 'error'
 
 
-def get_parameters(ipaddress: str, username: str, password: str):
-    camera_url = f'http://{ipaddress}/axis-cgi/param.cgi'
+def set_zoom(zoom_data: str, ipaddress: str, username: str, password: str):
+    data = {
+        'camera': 1,
+        'zoom': zoom_data,
+        'html': 'no',
+        'timestamp': int(time.time())
+    }
+
+    try:
+        get_client(ipaddress, username, password).post('/axis-cgi/com/ptz.cgi', data)
+        return 'ok'
+    except:
+        return 'error'
 
-    # ImageSource.I0.DayNight.IrCutFilter
 
+def center_PTZ(x: int, y: int, image_width: int, image_height: int, ipaddress: str, username: str, password: str):
+    """Points the camera at pixel x,y of an image_width x image_height view"""
     data = {
-        'action': 'list',
-        'group': 'Image.I0'
+        'camera': 1,
+        'center': f'{x},{y}',
+        'imagewidth': image_width,
+        'imageheight': image_height,
+        'html': 'no',
+        'timestamp': int(time.time())
     }
-    result = {}
 
-    camera_res = requests.post(
-        camera_url,
-        data = data,
-        auth = HTTPDigestAuth(username, password)
-        )
+    try:
+        get_client(ipaddress, username, password).post('/axis-cgi/com/ptz.cgi', data)
+        return 'ok'
+    except:
+        return 'error'
 
-    for line in camera_res.text.splitlines():
-        (name, var) = line.split('=', 2)
-        if name == 'root.Image.I0.Stream.FPS' or name == 'root.Image.I0.Appearance.Compression':
-            try:
-                result[name.strip()] = float(var)
-            except ValueError:
-                result[name.strip()] = var
 
-    return result
+def area_zoom(x: int, y: int, zoom: int, image_width: int, image_height: int, ipaddress: str, username: str, password: str):
+    """Centers on pixel x,y and zooms by zoom/100, more than 100 zooms in"""
+    data = {
+        'camera': 1,
+        'areazoom': f'{x},{y},{zoom}',
+        'imagewidth': image_width,
+        'imageheight': image_height,
+        'html': 'no',
+        'timestamp': int(time.time())
+    }
 
+    try:
+        get_client(ipaddress, username, password).post('/axis-cgi/com/ptz.cgi', data)
+        return 'ok'
+    except:
+        return 'error'
 
-def set_parameters(fps_data: int, compression_data: int, ipaddress: str, username: str, password: str):
-    camera_url = f'http://{ipaddress}/axis-cgi/param.cgi'
 
+def get_server_presets(ipaddress: str, username: str, password: str):
+    """Returns the names of the presets stored in the camera"""
+    data = { 'query': 'presetposall' }
+
+    try:
+        camera_res = get_client(ipaddress, username, password).post('/axis-cgi/com/ptz.cgi', data)
+        # Names are kept as text, parse_response would turn a preset named 1 into 1.0
+        presets = []
+        for line in camera_res.text.splitlines():
+            key, _, name = line.partition('=')
+            if key.strip().startswith('presetposno') and name.strip():
+                presets.append(name.strip())
+        return presets
+    except:
+        return 'error'
+
+
+def goto_server_preset(preset_name: str, ipaddress: str, username: str, password: str):
+    data = {
+        'camera': 1,
+        'gotoserverpresetname': preset_name,
+        'html': 'no',
+        'timestamp': int(time.time())
+    }
+
+    try:
+        get_client(ipaddress, username, password).post('/axis-cgi/com/ptz.cgi', data)
+        return 'ok'
+    except:
+        return 'error'
+
+
+def continuous_pan_tilt(pan_speed: int, tilt_speed: int, ipaddress: str, username: str, password: str):
+    """Moves at the given speeds (-100 to 100) until a new speed or 0,0 is sent"""
     data = {
-        'action': 'update',
-        'Image.I0.Stream.FPS': str(fps_data),
-        'Image.I0.Appearance.Compression': str(compression_data),
+        'camera': 1,
+        'continuouspantiltmove': f'{pan_speed},{tilt_speed}',
         'html': 'no',
         'timestamp': int(time.time())
     }
 
     try:
-        camera_res = requests.post(camera_url, data = data,  auth = HTTPDigestAuth(username, password))
+        get_client(ipaddress, username, password).post('/axis-cgi/com/ptz.cgi', data)
+        return 'ok'
+    except:
+        return 'error'
+
+
+def continuous_zoom(zoom_speed: int, ipaddress: str, username: str, password: str):
+    """Zooms at the given speed (-100 to 100) until a new speed or 0 is sent"""
+    data = {
+        'camera': 1,
+        'continuouszoommove': zoom_speed,
+        'html': 'no',
+        'timestamp': int(time.time())
+    }
+
+    try:
+        get_client(ipaddress, username, password).post('/axis-cgi/com/ptz.cgi', data)
+        return 'ok'
+    except:
+        return 'error'
+
+
+parameter_cache = parameters.ParameterCache(f'{sys.path[0]}/parameters.json')
+
+FPS_PARAMETER = 'root.Image.I0.Stream.FPS'
+COMPRESSION_PARAMETER = 'root.Image.I0.Appearance.Compression'
+
+def get_parameters(ipaddress: str, username: str, password: str):
+    # ImageSource.I0.DayNight.IrCutFilter
+
+    try:
+        values = parameter_cache.get(get_client(ipaddress, username, password), ipaddress, 'Image.I0')
+        return {name: values[name] for name in (FPS_PARAMETER, COMPRESSION_PARAMETER)}
+    except:
+        return 'error'
+
+
+def set_parameters(fps_data: int, compression_data: int, ipaddress: str, username: str, password: str):
+    values = {
+        FPS_PARAMETER: int(fps_data),
+        COMPRESSION_PARAMETER: int(compression_data),
+    }
+
+    try:
+        # Diffed against the camera, it may have been changed from its web page since the cache was filled
+        parameter_cache.update(get_client(ipaddress, username, password), ipaddress, 'Image.I0', values, fresh = True)
         return 'ok'
     except:
         return 'error'
@@ -207,21 +387,11 @@ def set_parameters(fps_data: int, compression_data: int, ipaddress: str, usernam
 
 def get_PTZ_limits(ipaddress: str, username: str, password: str):
     data = { 'query': 'limits' }
-    result = {}
-    camera_url = f'http://{ipaddress}/axis-cgi/com/ptz.cgi'
     timeout = 3 # seconds
 
     try:
-        camera_res = requests.post(camera_url, data = data, auth = HTTPDigestAuth(username, password))
-    
-        for line in camera_res.text.splitlines():
-            (name, var) = line.split('=', 2)
-            try:
-                result[name.strip()] = float(var)
-            except ValueError:
-                result[name.strip()] = var
-        
-        return result
+        camera_res = get_client(ipaddress, username, password).post('/axis-cgi/com/ptz.cgi', data, timeout)
+        return parse_response(camera_res.text)
     except:
         return 'error'
 
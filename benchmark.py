@@ -0,0 +1,394 @@
+import argparse
+import base64
+import contextlib
+import glob
+import hashlib
+import json
+import os
+import queue
+import re
+import struct
+import tempfile
+import threading
+import time
+import uuid
+import cv2
+import numpy as np
+import requests
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from requests.auth import HTTPDigestAuth
+from PyQt6.QtCore import Qt, QCoreApplication
+
+import backend
+import events
+import recorder
+import storage
+
+try:
+    import psycopg2
+    import psycopg2.extensions
+except ImportError:
+    psycopg2 = None
+
+
+# ------
+# Motion
+# ------
+def bench_motion(frames: int = 500, width: int = 1920, height: int = 1080):
+    """Per-frame cost of MotionDetector.update on full-HD frames, the budget is 1 ms"""
+    rng = np.random.default_rng(0)
+    images = [rng.integers(0, 256, (height, width, 3), dtype=np.uint8) for _ in range(8)]
+    detector = recorder.MotionDetector()
+    detector.update(images[0])
+
+    start = time.perf_counter()
+    for i in range(frames):
+        detector.update(images[i % len(images)])
+    elapsed = (time.perf_counter() - start) / frames
+
+    result = 'OK' if elapsed < 1e-3 else 'OVER BUDGET'
+    print(f'motion: {elapsed * 1e6:.1f} us/frame at {width}x{height} [{result}]')
+    return elapsed
+
+
+# -----
+# Remux
+# -----
+def bench_remux(frames: int = 250, width: int = 1280, height: int = 720):
+    """RemuxRecorder on a local file: every frame must reach the output, and a source ffmpeg
+    cannot open must stop it with an error. The ffmpeg binary is read from FFMPEG"""
+    ffmpeg = os.environ.get('FFMPEG', 'ffmpeg')
+    if not recorder.remux_available(ffmpeg):
+        print(f'remux: skipped, {ffmpeg} not found')
+        return None
+    with tempfile.TemporaryDirectory() as folder:
+        source = os.path.join(folder, 'source.avi')
+        writer = cv2.VideoWriter(source, cv2.VideoWriter_fourcc(*'MJPG'), 25, (width, height))
+        rng = np.random.default_rng(0)
+        for _ in range(frames):
+            writer.write(rng.integers(0, 256, (height, width, 3), dtype=np.uint8))
+        writer.release()
+
+        remux = recorder.RemuxRecorder(source, os.path.join(folder, 'remux'), ffmpeg)
+        start = time.perf_counter()
+        remux.start()
+        remux.process.wait(timeout=60)
+        elapsed = time.perf_counter() - start
+        remux.stop()
+        output = glob.glob(os.path.join(folder, 'remux_*.mkv'))[0]
+        capture = cv2.VideoCapture(output)
+        copied = 0
+        while capture.grab():
+            copied += 1
+        capture.release()
+        result = 'OK' if copied == frames else 'FAILED'
+        print(f'remux: {frames} frames at {width}x{height} copied in {elapsed * 1e3:.0f} ms, {copied} in output [{result}]')
+
+        broken = recorder.RemuxRecorder(os.path.join(folder, 'missing.avi'), os.path.join(folder, 'broken'), ffmpeg)
+        broken.start()
+        broken.process.wait(timeout=10)
+        error = broken.error()
+        result = 'OK' if not broken.is_running() and error else 'FAILED'
+        print(f'remux: unreadable source stops ffmpeg with "{error.splitlines()[-1] if error else ""}" [{result}]')
+        broken.stop()
+    return elapsed
+
+
+# -----------------
+# Mock VAPIX Server
+# -----------------
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+
+def read_websocket_frame(stream) -> str:
+    """Reads one text frame sent by a client, which always masks its payload"""
+    header = stream.read(2)
+    length = header[1] & 0x7f
+    if length == 126:
+        length = struct.unpack('!H', stream.read(2))[0]
+    elif length == 127:
+        length = struct.unpack('!Q', stream.read(8))[0]
+    mask = stream.read(4) if header[1] & 0x80 else bytes(4)
+    payload = stream.read(length)
+    return bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload)).decode()
+
+
+def websocket_frame(message: str) -> bytes:
+    payload = message.encode()
+    if len(payload) < 126:
+        header = struct.pack('!BB', 0x81, len(payload))
+    elif len(payload) < 65536:
+        header = struct.pack('!BBH', 0x81, 126, len(payload))
+    else:
+        header = struct.pack('!BBQ', 0x81, 127, len(payload))
+    return header + payload
+
+
+class MockVapixHandler(BaseHTTPRequestHandler):
+    """Answers ptz.cgi and param.cgi behind a digest challenge, the digest itself is not verified.
+    It also serves wssession.cgi and a ws-data-stream that forwards everything put in events"""
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    nonce = uuid.uuid4().hex
+    session = uuid.uuid4().hex
+    latency = 0.0
+    stats = {'connections': 0, 'requests': 0, 'challenges': 0}
+    events = queue.Queue()
+    subscriptions = []
+
+    def setup(self):
+        super().setup()
+        self.stats['connections'] += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def authorized(self) -> bool:
+        """Answers with a digest challenge unless the request carries the current nonce"""
+        if f'nonce="{self.nonce}"' in self.headers.get('Authorization', ''):
+            return True
+        self.stats['challenges'] += 1
+        self.send_response(401)
+        self.send_header('WWW-Authenticate', f'Digest realm="AXIS", nonce="{self.nonce}", qop="auth", algorithm=MD5')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        return False
+
+    def send_body(self, body: bytes):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.stats['requests'] += 1
+        time.sleep(self.latency)
+        if not self.authorized():
+            return
+        if self.path.startswith('/axis-cgi/param.cgi'):
+            self.send_body(b'root.Image.I0.Stream.FPS=25\nroot.Image.I0.Appearance.Compression=30\n')
+        else:
+            self.send_body(b'pan=10.5\ntilt=-5.0\nzoom=1\n')
+
+    def do_GET(self):
+        self.stats['requests'] += 1
+        if self.path.startswith('/axis-cgi/wssession.cgi'):
+            if self.authorized():
+                self.send_body(self.session.encode())
+        elif self.path.startswith('/vapix/ws-data-stream') and f'wssession={self.session}' in self.path:
+            self.serve_events()
+        else:
+            self.send_error(404)
+
+    def serve_events(self):
+        """Upgrades to a WebSocket, records the events:configure request and forwards events until None"""
+        key = self.headers['Sec-WebSocket-Key'] + WEBSOCKET_GUID
+        self.send_response(101)
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', base64.b64encode(hashlib.sha1(key.encode()).digest()).decode())
+        self.end_headers()
+        self.subscriptions.append(json.loads(read_websocket_frame(self.rfile)))
+        while True:
+            message = self.events.get()
+            if message is None:
+                break
+            self.wfile.write(websocket_frame(message))
+        self.close_connection = True
+
+
+def start_mock_vapix(latency: float = 0.0):
+    MockVapixHandler.latency = latency
+    server = ThreadingHTTPServer(('127.0.0.1', 0), MockVapixHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _run_calls(name: str, calls: int, call):
+    MockVapixHandler.stats.update(connections=0, requests=0, challenges=0)
+    start = time.perf_counter()
+    for _ in range(calls):
+        call()
+    elapsed = (time.perf_counter() - start) / calls
+    stats = MockVapixHandler.stats
+    print(f'{name}: {elapsed * 1e3:.2f} ms/call, {stats["connections"]} connections, '
+          f'{stats["requests"]} requests, {stats["challenges"]} challenges for {calls} calls')
+    return elapsed
+
+
+# -----
+# VAPIX
+# -----
+def bench_vapix(calls: int = 200, latency: float = 0.002):
+    """get_PTZ with a fresh requests.post per call against the pooled VapixClient"""
+    server = start_mock_vapix(latency)
+    address = f'127.0.0.1:{server.server_address[1]}'
+
+    def fresh_call():
+        res = requests.post(f'http://{address}/axis-cgi/com/ptz.cgi', data = {'query': 'position'},
+            auth = HTTPDigestAuth('root', 'pass'))
+        backend.parse_response(res.text)
+
+    before = _run_calls('vapix fresh connection', calls, fresh_call)
+    after = _run_calls('vapix pooled client', calls, lambda: backend.get_PTZ(address, 'root', 'pass'))
+    print(f'vapix: {before / after:.1f}x faster')
+    server.shutdown()
+    return before, after
+
+
+# -------------
+# Base de Datos
+# -------------
+def _storage_ops(name: str, current_storage, cycles: int):
+    """Add, look up, preset save and load, edit and delete of one camera per cycle"""
+    current_storage.create()
+    start = time.perf_counter()
+    for i in range(cycles):
+        camera_data = {'name': f'benchmark {i}', 'ip': f'10.0.{i // 250}.{i % 250}', 'username': 'root', 'password': 'pass'}
+        camera_id = current_storage.add_camera(camera_data)[0]
+        current_storage.get_camera(camera_data['name'])
+        current_storage.save_preset(camera_id, 'benchmark', 1.0, 2.0, 3.0)
+        current_storage.get_presets(camera_id)
+        current_storage.edit_camera(camera_id, camera_data)
+        current_storage.delete_camera(camera_data['name'])
+    ops = cycles * 6 / (time.perf_counter() - start)
+    print(f'db {name}: {ops:.0f} ops/s')
+    return ops
+
+
+if psycopg2 is not None:
+    class UnpreparedConnection(psycopg2.extensions.connection):
+        """Sends the storage statements as plain parameterized queries, like before the pool"""
+        def execute_prepared(self, cursor, statement: str, params: tuple = ()):
+            cursor.execute(re.sub(r'\$\d+', '%s', storage.POSTGRES_STATEMENTS[statement]), params)
+
+
+    class ConnectPerOperation(storage.PostgresStorage):
+        """Same statements as PostgresStorage over a new connection for every operation"""
+        def __init__(self, db_name: str, db_password: str):
+            self.connect_arguments = {'user': 'postgres', 'password': db_password, 'host': 'localhost',
+                'port': '5432', 'database': db_name, 'connect_timeout': 5}
+
+        @contextlib.contextmanager
+        def cursor(self):
+            connection = psycopg2.connect(connection_factory=UnpreparedConnection, **self.connect_arguments)
+            try:
+                yield connection, connection.cursor()
+                connection.commit()
+            finally:
+                connection.close()
+
+        def close(self):
+            pass
+
+
+def bench_db(cycles: int = 200, db_name: str = 'ip_cam_benchmark', db_password: str = None):
+    """The same camera and preset operations against every storage, in scratch databases.
+    Postgres runs with a connection per operation and with the pooled, prepared storage.
+    It needs a local server where the postgres user may create db_name, the password is read from PGPASSWORD"""
+    results = {}
+    with tempfile.TemporaryDirectory() as folder:
+        sqlite_storage = storage.SQLiteStorage(os.path.join(folder, 'benchmark.sqlite3'))
+        results['sqlite'] = _storage_ops('sqlite', sqlite_storage, cycles)
+        sqlite_storage.close()
+
+    if psycopg2 is None:
+        print('db postgres: skipped, psycopg2 is not installed')
+        return results
+    db_password = db_password or os.environ.get('PGPASSWORD', 'password')
+    try:
+        admin = psycopg2.connect(user='postgres', password=db_password, host='localhost', port='5432',
+            database='postgres', connect_timeout=5)
+    except psycopg2.Error as error:
+        print(f'db postgres: skipped, no database available ({str(error).splitlines()[0]})')
+        return results
+    admin.autocommit = True
+    cursor = admin.cursor()
+    cursor.execute(f'DROP DATABASE IF EXISTS {db_name}')
+    cursor.execute(f'CREATE DATABASE {db_name}')
+    try:
+        for name, open_storage in (('postgres connect per op', ConnectPerOperation),
+                                   ('postgres pooled', storage.PostgresStorage)):
+            current_storage = open_storage(db_name, db_password)
+            results[name] = _storage_ops(name, current_storage, cycles)
+            current_storage.close()
+        print(f'db postgres: {results["postgres pooled"] / results["postgres connect per op"]:.1f}x faster pooled')
+    finally:
+        cursor.execute(f'DROP DATABASE IF EXISTS {db_name}')
+        admin.close()
+    return results
+
+
+# ------
+# Events
+# ------
+def ptz_notification(data: dict) -> str:
+    return json.dumps({'apiVersion': '1.0', 'method': 'events:notify', 'params': {'notification': {
+        'topic': 'tns1:PTZController/tnsaxis:Move/Channel_1', 'timestamp': int(time.time() * 1000),
+        'message': {'source': {'PTZConfigurationToken': '1'}, 'key': {}, 'data': data}}}})
+
+
+def bench_events(events_count: int = 200):
+    """Delay from the fake camera pushing an event to EventSubscriber.position_signal, for positions
+    carried by the event and for move-stopped events that need one position read"""
+    if events.websocket is None:
+        print('events: skipped, websocket-client is not installed')
+        return None
+    app = QCoreApplication.instance() or QCoreApplication([])
+    server = start_mock_vapix()
+    MockVapixHandler.subscriptions.clear()
+    subscriber = events.EventSubscriber(f'127.0.0.1:{server.server_address[1]}', 'root', 'pass')
+    connected = threading.Event()
+    received = queue.Queue()
+    # Direct connections run in the subscriber thread, no event loop is needed
+    subscriber.connected_signal.connect(lambda state: state and connected.set(), Qt.ConnectionType.DirectConnection)
+    subscriber.position_signal.connect(received.put, Qt.ConnectionType.DirectConnection)
+    subscriber.start()
+    if not connected.wait(5):
+        print('events: FAILED, the subscriber did not connect')
+        subscriber.stop()
+        server.shutdown()
+        return None
+    topics = [item['topicFilter'] for item in MockVapixHandler.subscriptions[0]['params']['eventFilterList']]
+
+    results = {}
+    for name, data in (('pushed position', {'pan': '10.5', 'tilt': '-5.0', 'zoom': '1'}),
+                       ('move stopped', {'is_moving': '0'})):
+        elapsed = 0
+        for _ in range(events_count):
+            start = time.perf_counter()
+            MockVapixHandler.events.put(ptz_notification(data))
+            position = received.get(timeout=5)
+            elapsed += time.perf_counter() - start
+        assert position == {'pan': 10.5, 'tilt': -5.0, 'zoom': 1.0}, position
+        results[name] = elapsed / events_count
+        print(f'events {name}: {results[name] * 1e3:.2f} ms from push to signal')
+    print(f'events: subscribed to {", ".join(topics)}')
+
+    MockVapixHandler.events.put(None)
+    subscriber.stop()
+    server.shutdown()
+    return results
+
+
+BENCHMARKS = {
+    'motion': bench_motion,
+    'remux': bench_remux,
+    'vapix': bench_vapix,
+    'events': bench_events,
+    'db': bench_db,
+}
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description='Performance benchmarks')
+    parser.add_argument('names', nargs='*', help=f'benchmarks to run: {", ".join(BENCHMARKS)} (default: all)')
+    args = parser.parse_args()
+
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error(f'unknown benchmark: {name}')
+    for name in args.names or BENCHMARKS:
+        BENCHMARKS[name]()
@@ -0,0 +1,106 @@
+from PyQt6.QtCore import pyqtSignal, QThread
+
+import json
+import threading
+
+import backend
+
+try:
+    import websocket
+except ImportError:
+    websocket = None
+
+PTZ_TOPIC = 'tns1:PTZController//.'
+
+
+# ----------------
+# Event Subscriber
+# ----------------
+class EventSubscriber(QThread):
+    """Holds one VAPIX event stream (WebSocket) per camera and pushes PTZ position changes as
+    they happen. When a move ends the position is read once, so the GUI never has to poll.
+    Image parameters are not pushed, FPS and compression still come from the parameter cache.
+    Needs the optional websocket-client package"""
+    position_signal = pyqtSignal(dict)
+    connected_signal = pyqtSignal(bool)
+
+    def __init__(self, ipaddress: str, username: str, password: str, topics: list = None,
+                 reconnect_interval: float = 5.0, scheme: str = 'ws'):
+        super().__init__()
+        self._stop_event = threading.Event()
+        self.ipaddress = ipaddress
+        self.username = username
+        self.password = password
+        self.topics = topics or [PTZ_TOPIC]
+        self.reconnect_interval = reconnect_interval
+        self.scheme = scheme
+        self.connection = None
+
+    def run(self):
+        if websocket is None:
+            # Without the package the GUI keeps refreshing the position after each command
+            self.connected_signal.emit(False)
+            return
+        while not self._stop_event.is_set():
+            try:
+                self.connection = self.connect()
+            except Exception:
+                self.connected_signal.emit(False)
+                self._stop_event.wait(self.reconnect_interval)
+                continue
+
+            self.connected_signal.emit(True)
+            try:
+                while not self._stop_event.is_set():
+                    message = self.connection.recv()
+                    if message:
+                        self.handle_message(message)
+            except Exception:
+                pass
+            finally:
+                self.connection.close()
+                self.connection = None
+            if not self._stop_event.is_set():
+                self.connected_signal.emit(False)
+                self._stop_event.wait(self.reconnect_interval)
+
+    def stop(self):
+        self._stop_event.set()
+        connection = self.connection
+        if connection is not None:
+            # Unblocks recv()
+            connection.abort()
+        self.wait()
+
+    def connect(self):
+        """Opens the stream with a session token, the WebSocket upgrade itself cannot do digest auth"""
+        client = backend.get_client(self.ipaddress, self.username, self.password)
+        token = client.session.get(f'{client.base_url}/axis-cgi/wssession.cgi', timeout = client.timeout)
+        token.raise_for_status()
+        url = f'{self.scheme}://{self.ipaddress}/vapix/ws-data-stream?wssession={token.text.strip()}&sources=events'
+        # Bounded while connecting, so stop() never waits on a handshake that hangs
+        connection = websocket.create_connection(url, timeout = max(client.timeout))
+        connection.send(json.dumps({
+            'apiVersion': '1.0',
+            'method': 'events:configure',
+            'params': {'eventFilterList': [{'topicFilter': topic} for topic in self.topics]},
+        }))
+        # Events may be minutes apart, recv() is unblocked by stop() instead
+        connection.settimeout(None)
+        return connection
+
+    def handle_message(self, message: str):
+        try:
+            notification = json.loads(message)['params']['notification']
+            data = notification['message']['data']
+        except (ValueError, KeyError, TypeError):
+            return
+
+        position = {key: float(data[key]) for key in ('pan', 'tilt', 'zoom') if key in data}
+        if len(position) == 3:
+            self.position_signal.emit(position)
+        elif data.get('is_moving') in ('0', 0, False):
+            # Move events only say that the camera stopped, read where it stopped once
+            current_ptz = backend.get_PTZ(self.ipaddress, self.username, self.password)
+            if current_ptz != 'error':
+                self.position_signal.emit(current_ptz)
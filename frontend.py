@@ -1,56 +1,156 @@
 from turtle import back
 from PyQt6 import QtGui, QtWidgets
 from PyQt6.QtWidgets import QWidget, QApplication
-from PyQt6.QtGui import QPixmap
-from PyQt6.QtCore import pyqtSignal, pyqtSlot, Qt, QThread, QSettings
+from PyQt6.QtCore import pyqtSignal, pyqtSlot, Qt, QThread, QSettings, QTimer
 
+import logging
+import os
 import sys
+import threading
+import time
 import cv2
-import numpy as np
-import psycopg2
+from concurrent.futures import ThreadPoolExecutor
 
 import material3_components as mt3
 import widgets
 import backend
 import camera
+import video
+import recorder
+import ptz
+import events
+import inventory
+import jobs
+
+logger = logging.getLogger(__name__)
 
 
 # ---------
 # Funciones
 # ---------
 class VideoThread(QThread):
-    change_pixmap_signal = pyqtSignal(np.ndarray)
+    motion_signal = pyqtSignal(bool)
 
-    def __init__(self, username, password, ip_address):
+    def __init__(self, username, password, ip_address, pool_size=6, pre_event_seconds=0, pre_event_bytes=0):
         super().__init__()
         self._run_flag = True
         self.username = username
         self.password = password
         self.ip_address = ip_address
+        self.source = f'rtsp://{username}:{password}@{ip_address}/axis-media/media.amp?Transport=multicast'
+        self.pool_size = pool_size
+        self.pre_event_seconds = pre_event_seconds
+        self.pre_event_bytes = pre_event_bytes
         # Video data
-        self.frame = None
+        self.pool = None
+        self.mailbox = video.FrameMailbox(self.release_frame)
         self.width = 0
         self.height = 0
-        self.output = None
+        self.recorder = None
+        self.timings = {}
+        self.pre_event = None
+        self.motion = None
+        self._recorder_lock = threading.Lock()
         
     def run(self):
         # capture from web cam
-        source = f'rtsp://{self.username}:{self.password}@{self.ip_address}/axis-media/media.amp?Transport=multicast'
-
-        cap = cv2.VideoCapture(source)
+        start = time.perf_counter()
+        cap = cv2.VideoCapture(self.source)
+        self.timings['rtsp_open'] = time.perf_counter() - start
         self.width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
         self.height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        if self.pre_event_seconds > 0:
+            fps = cap.get(cv2.CAP_PROP_FPS)
+            if not 1 <= fps <= 120:
+                # RTSP sources may report the 90 kHz clock rate instead of the frame rate
+                fps = 25
+            self.pre_event = recorder.PreEventBuffer(self.pre_event_seconds, fps, self.pre_event_bytes)
         while self._run_flag:
-            ret, cv_img = cap.read()
+            buffer = self.pool.acquire() if self.pool is not None else None
+            ret, cv_img = cap.read(image=buffer)
+            if cv_img is not buffer:
+                # The stream changed size or the pool was exhausted
+                self.release_frame(buffer)
             if ret:
-                self.change_pixmap_signal.emit(cv_img)
+                if self.pool is None:
+                    self.pool = video.FramePool(self.pool_size, cv_img.shape)
+                    self.timings['first_read'] = time.perf_counter() - start
+                with self._recorder_lock:
+                    if self.pre_event is not None:
+                        self.pre_event.push(cv_img)
+                    if self.recorder is not None:
+                        # The recorder holds the buffer until the frame is written
+                        self.pool.retain(cv_img)
+                        self.recorder.write(cv_img)
+                detector = self.motion
+                if detector is not None:
+                    active = detector.active
+                    if detector.update(cv_img) != active:
+                        self.motion_signal.emit(not active)
+                self.mailbox.put(cv_img)
+            else:
+                self.release_frame(cv_img)
         # shut down capture system
         cap.release()
+        self.mailbox.clear()
 
-    def stop(self):
+    def stop(self, wait=True):
         """Sets run flag to False and waits for thread to finish"""
         self._run_flag = False
-        self.wait()
+        if wait:
+            self.wait()
+
+    def drain_pre_event(self) -> list:
+        """Takes the pre-event frames without attaching a recorder, empty if there is no ring"""
+        with self._recorder_lock:
+            return self.pre_event.drain() if self.pre_event is not None else []
+
+    def attach_recorder(self, output):
+        """Starts feeding frames to a recorder, preceded by the pre-event frames. None detaches it"""
+        with self._recorder_lock:
+            if output is not None and self.pre_event is not None:
+                output.preroll = self.pre_event.drain()
+            self.recorder = output
+
+    def release_frame(self, frame):
+        """Returns a frame to the buffer pool once its holder is done with it"""
+        if self.pool is not None:
+            self.pool.release(frame)
+
+
+class HandshakeThread(QThread):
+    """Runs the connection probes of a camera concurrently and times each one"""
+    result_signal = pyqtSignal(dict, dict)
+
+    def __init__(self, ip_address, username, password):
+        super().__init__()
+        self.ip_address = ip_address
+        self.username = username
+        self.password = password
+
+    def run(self):
+        start = time.perf_counter()
+        timings = {}
+        probes = {
+            'get_PTZ': backend.get_PTZ,
+            'get_PTZ_limits': backend.get_PTZ_limits,
+            'get_parameters': backend.get_parameters,
+            'get_server_presets': backend.get_server_presets,
+        }
+        with ThreadPoolExecutor(max_workers=len(probes)) as executor:
+            futures = {name: executor.submit(self.timed, function, name, timings) for name, function in probes.items()}
+            results = {name: future.result() for name, future in futures.items()}
+        timings['total'] = time.perf_counter() - start
+        self.result_signal.emit(results, timings)
+
+    def timed(self, function, name, timings):
+        start = time.perf_counter()
+        try:
+            return function(self.ip_address, self.username, self.password)
+        except Exception:
+            return 'error'
+        finally:
+            timings[name] = time.perf_counter() - start
 
 
 class App(QWidget):
@@ -62,19 +162,82 @@ class App(QWidget):
         self.settings = QSettings(f'{sys.path[0]}/settings.ini', QSettings.Format.IniFormat)
         self.language_value = int(self.settings.value('language'))
         self.theme_value = eval(self.settings.value('theme'))
+        self.renderer_value = self.settings.value('renderer', 'label')
+        self.record_queue_value = int(self.settings.value('record_queue', 64))
+        self.record_overflow_value = self.settings.value('record_overflow', 'drop_oldest')
+        self.record_mode_value = self.settings.value('record_mode', 'encode')
+        self.record_root_value = self.settings.value('record_root', '') or f'{sys.path[0]}/recordings'
+        self.segment_seconds_value = float(self.settings.value('segment_seconds', 0))
+        self.segment_megabytes_value = float(self.settings.value('segment_megabytes', 0))
+        self.quota_gigabytes_value = float(self.settings.value('quota_gigabytes', 0))
+        self.max_age_days_value = float(self.settings.value('max_age_days', 0))
+        self.pre_event_seconds_value = float(self.settings.value('pre_event_seconds', 0))
+        self.pre_event_megabytes_value = float(self.settings.value('pre_event_megabytes', 64))
+        self.record_trigger_value = self.settings.value('record_trigger', 'manual')
+        self.motion_threshold_value = int(self.settings.value('motion_threshold', 25))
+        self.motion_area_value = float(self.settings.value('motion_area', 0.01))
+        self.motion_mask_value = self.settings.value('motion_mask', '')
+        self.motion_start_frames_value = int(self.settings.value('motion_start_frames', 3))
+        self.motion_stop_seconds_value = float(self.settings.value('motion_stop_seconds', 5))
+        self.ptz_speed_value = int(self.settings.value('ptz_speed', 50))
+        self.zoom_rate_value = float(self.settings.value('zoom_rate', 10))
+        self.event_stream_value = self.settings.value('event_stream', 'on') == 'on'
+        self.parameter_ttl_value = float(self.settings.value('parameter_ttl', 3600))
+        self.storage_value = self.settings.value('storage', 'postgres')
 
         self.idioma_dict = {0: ('ESP', 'SPA'), 1: ('ING', 'ENG')}
 
         # -------------
         # Base de Datos
         # -------------
-        self.ip_cameras_value = backend.create_db('ip_cam', 'password')
+        backend.storage_kind = self.storage_value
+        self.jobs = jobs.JobRunner(parent=self)
+        # The menu starts from the local copy, the database is read in the background
+        self.inventory_cache = inventory.InventoryCache(f'{sys.path[0]}/cameras.json')
+        self.camera_model = inventory.CameraListModel(self.inventory_cache.load())
+        # Saved once per reconcile or edit, not once per changed row
+        self.inventory_save_timer = QTimer(self)
+        self.inventory_save_timer.setSingleShot(True)
+        self.inventory_save_timer.setInterval(0)
+        self.inventory_save_timer.timeout.connect(self.save_inventory)
+        for signal in (self.camera_model.rowsInserted, self.camera_model.rowsRemoved,
+                       self.camera_model.dataChanged, self.camera_model.modelReset):
+            signal.connect(lambda *args: self.inventory_save_timer.start())
+        self.inventory_sync = inventory.InventorySync(lambda: backend.create_db('ip_cam', 'password'))
+        self.inventory_sync.rows_signal.connect(self.on_inventory_rows)
+        self.inventory_sync.start()
+        backend.parameter_cache.ttl = self.parameter_ttl_value
+
+        # -----------
+        # Grabaciones
+        # -----------
+        self.sweeper = recorder.RetentionSweeper(self.record_root_value,
+            int(self.quota_gigabytes_value * 1024**3), self.max_age_days_value * 86400)
+        self.sweeper.start()
+        self.recorder = None
+        self.remux_timer = QTimer(self)
+        self.remux_timer.setInterval(1000)
+        self.remux_timer.timeout.connect(self.check_remux)
+        # Created by on_start_button_clicked and on_handshake_finished
+        self.thread = None
+        self.render_thread = None
+        self.ptz_worker = None
+        self.ptz_error_shown = False
+        self.handshake = None
+        self.startup_timings = {}
+        self.closing_threads = []
+        self.presets = {}
+        self.server_presets = set()
+        # Camera the stream was started for, the menu selection may change while it runs
+        self.stream_camera_id = None
+        self.stream_camera_name = ''
+        self.subscriber = None
 
         # ----------------
         # Generación de UI
         # ----------------
         width = 1720
-        height = 860
+        height = 900
         screen_x = int(self.screen().availableGeometry().width() / 2 - (width / 2))
         screen_y = int(self.screen().availableGeometry().height() / 2 - (height / 2))
 
@@ -83,7 +246,8 @@ class App(QWidget):
         elif self.language_value == 1:
             self.setWindowTitle('Camera Live Video')
         self.setGeometry(screen_x, screen_y, width, height)
-        self.setMinimumSize(width, height)
+        # Side columns take 420 px, the image card can shrink to 540 px wide
+        self.setMinimumSize(960, height)
         if self.theme_value:
             self.setStyleSheet(f'QWidget {{ background-color: #E5E9F0; color: #000000 }}'
                 f'QComboBox QListView {{ border: 1px solid #000000; border-radius: 5; padding: 0 10 0 10;'
@@ -157,9 +321,8 @@ class App(QWidget):
 
         y_1 += 20
         self.ipaddress_menu = mt3.Menu(self.camara_card, 'ipaddress_menu',
-            (10, y_1, 170), 10, 10, {}, self.theme_value, self.language_value)
-        for data in self.ip_cameras_value:
-            self.ipaddress_menu.add_item(data[1])
+            (10, y_1, 170), 10, 10000, {}, self.theme_value, self.language_value)
+        self.ipaddress_menu.setModel(self.camera_model)
         self.ipaddress_menu.setCurrentIndex(-1)
         self.ipaddress_menu.currentIndexChanged.connect(self.on_ipaddress_menu_currentIndexChanged)
 
@@ -232,9 +395,10 @@ class App(QWidget):
         self.imagen_card = mt3.Card(self, 'imagen_card',
             (210, 70, 1300, 740), self.theme_value)
 
-        self.image_label = QtWidgets.QLabel(self.imagen_card)
-        self.image_label.setGeometry(10, 10, 1280, 720)
-        self.image_label.setFrameStyle(QtWidgets.QFrame.Shape.Box)
+        self.image_label = video.create_surface(self.imagen_card, (10, 10, 1280, 720), self.renderer_value)
+        self.aim_controller = video.AimController(self.image_label)
+        self.aim_controller.center_signal.connect(self.on_image_label_center)
+        self.aim_controller.area_signal.connect(self.on_image_label_area)
 
         # --------------
         # Card Controles
@@ -251,33 +415,59 @@ class App(QWidget):
             (85, y_4), '', self.theme_value)
         self.up_control_button.setArrowType(Qt.ArrowType.UpArrow)
         self.up_control_button.setEnabled(False)
-        self.up_control_button.clicked.connect(self.on_up_control_button_clicked)
+        self.up_control_button.pressed.connect(self.on_up_control_button_pressed)
+        self.up_control_button.released.connect(self.on_control_button_released)
 
         y_4 += 30
         self.left_control_button = mt3.IconButton(self.controles_card, 'left_control_button',
             (55, y_4), '', self.theme_value)
         self.left_control_button.setArrowType(Qt.ArrowType.LeftArrow)
         self.left_control_button.setEnabled(False)
-        self.left_control_button.clicked.connect(self.on_left_control_button_clicked)
+        self.left_control_button.pressed.connect(self.on_left_control_button_pressed)
+        self.left_control_button.released.connect(self.on_control_button_released)
 
         self.right_control_button = mt3.IconButton(self.controles_card, 'right_control_button',
             (115, y_4), '', self.theme_value)
         self.right_control_button.setArrowType(Qt.ArrowType.RightArrow)
         self.right_control_button.setEnabled(False)
-        self.right_control_button.clicked.connect(self.on_right_control_button_clicked)
+        self.right_control_button.pressed.connect(self.on_right_control_button_pressed)
+        self.right_control_button.released.connect(self.on_control_button_released)
 
         y_4 += 30
         self.down_control_button = mt3.IconButton(self.controles_card, 'down_control_button',
             (85, y_4), '', self.theme_value)
         self.down_control_button.setArrowType(Qt.ArrowType.DownArrow)
         self.down_control_button.setEnabled(False)
-        self.down_control_button.clicked.connect(self.on_down_control_button_clicked)
+        self.down_control_button.pressed.connect(self.on_down_control_button_pressed)
+        self.down_control_button.released.connect(self.on_control_button_released)
+
+        self.zoomIn_control_button = mt3.IconButton(self.controles_card, 'zoomIn_control_button',
+            (150, 50), '', self.theme_value)
+        self.zoomIn_control_button.setToolButtonStyle(Qt.ToolButtonStyle.ToolButtonTextOnly)
+        self.zoomIn_control_button.setText('+')
+        self.zoomIn_control_button.setEnabled(False)
+        self.zoomIn_control_button.pressed.connect(self.on_zoomIn_control_button_pressed)
+        self.zoomIn_control_button.released.connect(self.on_control_button_released)
+
+        self.zoomOut_control_button = mt3.IconButton(self.controles_card, 'zoomOut_control_button',
+            (150, 110), '', self.theme_value)
+        self.zoomOut_control_button.setToolButtonStyle(Qt.ToolButtonStyle.ToolButtonTextOnly)
+        self.zoomOut_control_button.setText('-')
+        self.zoomOut_control_button.setEnabled(False)
+        self.zoomOut_control_button.pressed.connect(self.on_zoomOut_control_button_pressed)
+        self.zoomOut_control_button.released.connect(self.on_control_button_released)
+
+        # Continuous moves are refreshed while a control button is held
+        self.velocity = (0, 0, 0)
+        self.velocity_timer = QTimer(self)
+        self.velocity_timer.setInterval(1000)
+        self.velocity_timer.timeout.connect(self.send_velocity)
 
         # -------------
         # Card Posición
         # -------------
         self.posicion_card = mt3.Card(self, 'posicion_card',
-            (1520, 230, 190, 380), self.theme_value)
+            (1520, 230, 190, 420), self.theme_value)
 
         y_5 = 10
         self.position_label = mt3.TitleLabel(self.posicion_card, 'position_label',
@@ -311,6 +501,7 @@ class App(QWidget):
         self.zoom_slider.setEnabled(False)
         self.zoom_slider.sliderMoved.connect(self.on_zoom_slider_sliderMoved)
         self.zoom_slider.sliderReleased.connect(self.on_zoom_slider_sliderReleased)
+        self.zoom_limiter = ptz.RateLimiter(self.send_zoom, self.zoom_rate_value, self)
 
         y_5 += 40
         self.getPTZ_button = mt3.TextButton(self.posicion_card, 'getPTZ_button',
@@ -324,11 +515,22 @@ class App(QWidget):
         self.setPTZ_button.setEnabled(False)
         self.setPTZ_button.clicked.connect(self.on_setPTZ_button_clicked)
 
+        y_5 += 40
+        self.preset_menu = mt3.Menu(self.posicion_card, 'preset_menu',
+            (10, y_5, 130), 10, 100, {}, self.theme_value, self.language_value)
+        self.preset_menu.setEnabled(False)
+        self.preset_menu.activated.connect(self.on_preset_menu_activated)
+
+        self.savePreset_button = mt3.IconButton(self.posicion_card, 'savePreset_button',
+            (150, y_5), 'new.png', self.theme_value)
+        self.savePreset_button.setEnabled(False)
+        self.savePreset_button.clicked.connect(self.on_savePreset_button_clicked)
+
         # ---------------
         # Card Parámetros
         # ---------------
         self.parametros_card = mt3.Card(self, 'parametros_card',
-            (1520, 620, 190, 230), self.theme_value)
+            (1520, 660, 190, 230), self.theme_value)
 
         y_6 = 10
         self.parameters_label = mt3.TitleLabel(self.parametros_card, 'parameters_label',
@@ -438,6 +640,8 @@ class App(QWidget):
         self.left_control_button.apply_styleSheet(index)
         self.right_control_button.apply_styleSheet(index)
         self.down_control_button.apply_styleSheet(index)
+        self.zoomIn_control_button.apply_styleSheet(index)
+        self.zoomOut_control_button.apply_styleSheet(index)
         
         self.posicion_card.apply_styleSheet(index)
         self.position_label.apply_styleSheet(index)
@@ -450,6 +654,8 @@ class App(QWidget):
         self.zoom_slider.apply_styleSheet(index)
         self.getPTZ_button.apply_styleSheet(index)
         self.setPTZ_button.apply_styleSheet(index)
+        self.preset_menu.apply_styleSheet(index)
+        self.savePreset_button.apply_styleSheet(index)
 
         self.parametros_card.apply_styleSheet(index)
         self.parameters_label.apply_styleSheet(index)
@@ -483,20 +689,8 @@ class App(QWidget):
         self.camera_window.exec()
 
         if self.camera_window.camera_data:
-            self.ip_cameras_value = backend.add_db(self.camera_window.camera_data, 'ip_cam', 'ecf406MetroidPrime')
-
-            self.ipaddress_menu.clear()
-            for data in self.ip_cameras_value:
-                self.ipaddress_menu.add_item(data[1])
-            self.ipaddress_menu.setCurrentIndex(-1)
-            self.ipaddress_value.setText('')
-            self.user_value.setText('')
-            self.password_value.setText('')
-
-            if self.language_value == 0:
-                QtWidgets.QMessageBox.information(self, 'Datos Guardados', 'Cámara agregada a la base de datos')
-            elif self.language_value == 1:
-                QtWidgets.QMessageBox.information(self, 'Data Saved', 'Camera added to database')
+            self.jobs.submit(backend.add_db, self.camera_window.camera_data, 'ip_cam', 'ecf406MetroidPrime',
+                on_result=self.on_camera_added, on_error=self.on_db_error)
         else:
             if self.language_value == 0:
                 QtWidgets.QMessageBox.critical(self, 'Error de Datos', 'No se dio información de una cámara nueva')
@@ -505,35 +699,21 @@ class App(QWidget):
 
 
     def on_editar_button_clicked(self):
-        camera_name = self.ipaddress_menu.currentText()
+        data = self.camera_model.row(self.ipaddress_menu.currentIndex())
         
-        if camera_name != '':
-            data = backend.get_db(camera_name, 'ip_cam', 'ecf406MetroidPrime')
-
-            camera_id = data[0][0]
+        if data is not None:
+            camera_id = data[0]
             self.camera_window = camera.Camera()
-            self.camera_window.nombre_text.setText(data[0][1])
-            self.camera_window.ip_text.setText(data[0][2])
-            self.camera_window.username_text.setText(data[0][3])
-            self.camera_window.password_text.setText(data[0][4])
+            self.camera_window.nombre_text.setText(data[1])
+            self.camera_window.ip_text.setText(data[2])
+            self.camera_window.username_text.setText(data[3])
+            self.camera_window.password_text.setText(data[4])
 
             self.camera_window.exec()
 
             if self.camera_window.camera_data:
-                self.ip_cameras_value = backend.edit_db(camera_id, self.camera_window.camera_data, 'ip_cam', 'ecf406MetroidPrime')
-
-                self.ipaddress_menu.clear()
-                for data in self.ip_cameras_value:
-                    self.ipaddress_menu.add_item(data[1])
-                self.ipaddress_menu.setCurrentIndex(-1)
-                self.ipaddress_value.setText('')
-                self.user_value.setText('')
-                self.password_value.setText('')
-
-                if self.language_value == 0:
-                    QtWidgets.QMessageBox.information(self, 'Datos Guardados', 'Cámara editada en la base de datos')
-                elif self.language_value == 1:
-                    QtWidgets.QMessageBox.information(self, 'Data Saved', 'Camera edited in database')
+                self.jobs.submit(backend.edit_db, camera_id, self.camera_window.camera_data, 'ip_cam', 'ecf406MetroidPrime',
+                    on_result=lambda camera_row: self.on_camera_edited(camera_id, camera_row), on_error=self.on_db_error)
             else:
                 if self.language_value == 0:
                     QtWidgets.QMessageBox.critical(self, 'Error de Datos', 'No se dio información de la cámara')
@@ -550,20 +730,8 @@ class App(QWidget):
         camera_name = self.ipaddress_menu.currentText()
 
         if camera_name != '':
-            self.ip_cameras_value = backend.delete_db(camera_name, 'ip_cam', 'ecf406MetroidPrime')
-
-            self.ipaddress_menu.clear()
-            for data in self.ip_cameras_value:
-                self.ipaddress_menu.add_item(data[1])
-            self.ipaddress_menu.setCurrentIndex(-1)
-            self.ipaddress_value.setText('')
-            self.user_value.setText('')
-            self.password_value.setText('')
-
-            if self.language_value == 0:
-                QtWidgets.QMessageBox.information(self, 'Datos Guardados', 'Cámara eliminada de la base de datos')
-            elif self.language_value == 1:
-                QtWidgets.QMessageBox.information(self, 'Data Saved', 'Camera deleted from database')
+            self.jobs.submit(backend.delete_db, camera_name, 'ip_cam', 'ecf406MetroidPrime',
+                on_result=self.on_camera_deleted, on_error=self.on_db_error)
         else:
             if self.language_value == 0:
                 QtWidgets.QMessageBox.critical(self, 'Error de Cámara', 'No se seleccionó una cámara')
@@ -571,14 +739,79 @@ class App(QWidget):
                 QtWidgets.QMessageBox.critical(self, 'Camera Error', 'No camera selected')
 
 
+    def on_camera_added(self, camera_row: tuple):
+        self.camera_model.upsert(camera_row)
+        self.clear_camera_selection()
+
+        if self.language_value == 0:
+            QtWidgets.QMessageBox.information(self, 'Datos Guardados', 'Cámara agregada a la base de datos')
+        elif self.language_value == 1:
+            QtWidgets.QMessageBox.information(self, 'Data Saved', 'Camera added to database')
+
+
+    def on_camera_edited(self, camera_id: int, camera_row: tuple):
+        if camera_row is None:
+            self.camera_model.remove(camera_id)
+        else:
+            self.camera_model.upsert(camera_row)
+        self.clear_camera_selection()
+
+        if self.language_value == 0:
+            QtWidgets.QMessageBox.information(self, 'Datos Guardados', 'Cámara editada en la base de datos')
+        elif self.language_value == 1:
+            QtWidgets.QMessageBox.information(self, 'Data Saved', 'Camera edited in database')
+
+
+    def on_camera_deleted(self, camera_ids: list):
+        for camera_id in camera_ids:
+            self.camera_model.remove(camera_id)
+        self.clear_camera_selection()
+
+        if self.language_value == 0:
+            QtWidgets.QMessageBox.information(self, 'Datos Guardados', 'Cámara eliminada de la base de datos')
+        elif self.language_value == 1:
+            QtWidgets.QMessageBox.information(self, 'Data Saved', 'Camera deleted from database')
+
+
+    def clear_camera_selection(self):
+        self.ipaddress_menu.setCurrentIndex(-1)
+        self.ipaddress_value.setText('')
+        self.user_value.setText('')
+        self.password_value.setText('')
+
+
+    def on_db_error(self, error: Exception):
+        if self.language_value == 0:
+            QtWidgets.QMessageBox.critical(self, 'Error de Base de Datos', f'No se pudo guardar en la base de datos\n{error}')
+        elif self.language_value == 1:
+            QtWidgets.QMessageBox.critical(self, 'Database Error', f'Could not save to the database\n{error}')
+
+
     def on_ipaddress_menu_currentIndexChanged(self, index: int):
         if index != -1:
-            self.ipaddress_value.setText(self.ip_cameras_value[self.ipaddress_menu.currentIndex()][2])
-            self.user_value.setText(self.ip_cameras_value[self.ipaddress_menu.currentIndex()][3])
-            self.password_value.setText(self.ip_cameras_value[self.ipaddress_menu.currentIndex()][4])
-            if not self.stop_button.isEnabled():
+            data = self.camera_model.row(index)
+            self.ipaddress_value.setText(data[2])
+            self.user_value.setText(data[3])
+            self.password_value.setText(data[4])
+            if not self.stop_button.isEnabled() and self.handshake is None:
                 self.start_button.setEnabled(True)
+
+
+    def on_inventory_rows(self, rows: list):
+        if self.ipaddress_menu.currentIndex() != -1:
+            self.camera_model.reconcile(rows)
+            return
+        # Rows inserted into an empty menu select the first one, keep the menu without a selection
+        self.ipaddress_menu.blockSignals(True)
+        self.camera_model.reconcile(rows)
+        self.ipaddress_menu.setCurrentIndex(-1)
+        self.ipaddress_menu.blockSignals(False)
+
+
+    def save_inventory(self):
+        self.inventory_cache.save(self.camera_model.rows)
     
+
     # ------------------
     # Funciones Opciones
     # ------------------
@@ -586,13 +819,41 @@ class App(QWidget):
         username = self.user_value.text()
         password = self.password_value.text()
         ip_address = self.ipaddress_value.text()
+        self.start_button.setEnabled(False)
+        camera_row = self.camera_model.row(self.ipaddress_menu.currentIndex())
+        self.stream_camera_id = camera_row[0] if camera_row is not None else None
+        # Recordings are filed under this name, even if the menu is cleared while streaming
+        self.stream_camera_name = camera_row[1] if camera_row is not None else ''
+
+        # The RTSP stream opens while the camera is probed
+        self.startup_start = time.perf_counter()
+        self.startup_timings = {}
+        self.thread = VideoThread(username, password, ip_address, pre_event_seconds=self.pre_event_seconds_value,
+            pre_event_bytes=int(self.pre_event_megabytes_value * 1024**2)) # create the video capture thread        
+        if self.image_label.scales_on_draw:
+            self.render_thread = video.RenderThread(self.thread.mailbox, self.thread.release_frame, None)
+        else:
+            size, ratio = self.image_label.pixel_size()
+            self.render_thread = video.RenderThread(self.thread.mailbox, self.thread.release_frame, size, ratio)
+        self.render_thread.image_ready_signal.connect(self.update_image) # connect its signal to the update_image slot
+        self.thread.start()
+        self.render_thread.start()
 
         # Check connection
-        current_ptz = backend.get_PTZ(ip_address, username, password)
+        self.handshake = HandshakeThread(ip_address, username, password)
+        self.handshake.result_signal.connect(self.on_handshake_finished)
+        self.handshake.start()
+
 
-        if current_ptz != 'error':
-            ptz_limits = backend.get_PTZ_limits(ip_address, username, password)
+    def on_handshake_finished(self, results: dict, timings: dict):
+        self.handshake = None
+        current_ptz = results['get_PTZ']
+        ptz_limits = results['get_PTZ_limits']
+        parameters = results['get_parameters']
+        self.startup_timings.update(timings)
+        self.report_startup_timings()
 
+        if 'error' not in (current_ptz, ptz_limits, parameters):
             self.pan_text.setMinimum(int(ptz_limits['MinPan']))
             self.pan_text.setMaximum(int(ptz_limits['MaxPan']))
             self.tilt_text.setMinimum(int(ptz_limits['MinTilt']))
@@ -600,38 +861,76 @@ class App(QWidget):
             self.zoom_text.setMinimum(int(ptz_limits['MinZoom']))
             self.zoom_text.setMaximum(int(ptz_limits['MaxZoom']))
 
-            self.thread = VideoThread(username, password, ip_address) # create the video capture thread        
-            self.thread.change_pixmap_signal.connect(self.update_image) # connect its signal to the update_image slot
-            self.thread.start()
+            self.ptz_worker = ptz.PTZWorker(self.thread.ip_address, self.thread.username, self.thread.password)
+            self.ptz_worker.position_signal.connect(self.on_ptz_position)
+            self.ptz_worker.error_signal.connect(self.on_ptz_error)
+            self.ptz_worker.start()
+
+            self.subscriber = None
+            if self.event_stream_value:
+                self.subscriber = events.EventSubscriber(self.thread.ip_address, self.thread.username, self.thread.password)
+                self.subscriber.position_signal.connect(self.on_ptz_position)
+                self.subscriber.connected_signal.connect(self.on_event_stream_connected)
+                self.subscriber.start()
 
             self.pan_text.setValue(int(current_ptz['pan']))
             self.tilt_text.setValue(int(current_ptz['tilt']))
             self.zoom_text.setValue(int(current_ptz['zoom']))
             self.zoom_slider.setValue(int(current_ptz['zoom']))
 
-            parameters = backend.get_parameters(ip_address, username, password)
             self.fps_text.setValue(int(parameters['root.Image.I0.Stream.FPS']))
             self.compression_spin.setValue(int(parameters['root.Image.I0.Appearance.Compression']))
 
-            self.start_button.setEnabled(False)
+            # Cameras without server presets are recalled with an absolute move
+            server_presets = results['get_server_presets']
+            self.server_presets = set(server_presets) if server_presets != 'error' else set()
+            self.load_presets()
+
             self.stop_button.setEnabled(True)
             self.record_button.setEnabled(True)
             self.up_control_button.setEnabled(True)
             self.left_control_button.setEnabled(True)
             self.right_control_button.setEnabled(True)
             self.down_control_button.setEnabled(True)
+            self.zoomIn_control_button.setEnabled(True)
+            self.zoomOut_control_button.setEnabled(True)
             self.zoom_slider.setEnabled(True)
             self.getPTZ_button.setEnabled(True)
             self.setPTZ_button.setEnabled(True)
+            self.preset_menu.setEnabled(True)
+            self.savePreset_button.setEnabled(self.stream_camera_id is not None)
             self.setParameters_button.setEnabled(True)
         else:
+            # The capture may still be blocked opening the stream, it is stopped without waiting
+            self.render_thread.stop()
+            self.thread.stop(wait=False)
+            self.closing_threads.append(self.thread)
+            self.thread.finished.connect(lambda thread=self.thread: self.closing_threads.remove(thread))
+            self.start_button.setEnabled(True)
             if self.language_value == 0:
                 error_message = QtWidgets.QMessageBox.critical(self, 'Error de Conexión', 'No hubo conexión con la cámara')
             elif self.language_value == 1:
                 error_message = QtWidgets.QMessageBox.critical(self, 'Connection Error', 'There was no connection to the camera')
 
 
+    def report_startup_timings(self):
+        """Logs the duration of each start phase once the probes and the first frame are done"""
+        if 'total' not in self.startup_timings or 'first_frame' not in self.startup_timings:
+            return
+        self.startup_timings.update(self.thread.timings)
+        phases = ', '.join(f'{name} {value * 1000:.0f} ms' for name, value in self.startup_timings.items())
+        logger.info('Startup %s: %s', self.thread.ip_address, phases)
+
+
     def on_stop_button_clicked(self):
+        if self.record_button.isChecked():
+            self.record_button.set_state(False)
+            self.on_record_button_clicked()
+        self.on_control_button_released()
+        self.ptz_worker.stop()
+        if self.subscriber is not None:
+            self.subscriber.stop()
+        self.render_thread.stop()
         self.thread.stop()
 
         self.start_button.setEnabled(True)
@@ -641,156 +940,314 @@ class App(QWidget):
         self.left_control_button.setEnabled(False)
         self.right_control_button.setEnabled(False)
         self.down_control_button.setEnabled(False)
+        self.zoomIn_control_button.setEnabled(False)
+        self.zoomOut_control_button.setEnabled(False)
         self.zoom_slider.setEnabled(False)
         self.getPTZ_button.setEnabled(False)
         self.setPTZ_button.setEnabled(False)
+        self.preset_menu.setEnabled(False)
+        self.savePreset_button.setEnabled(False)
         self.setParameters_button.setEnabled(False)
 
 
     def on_record_button_clicked(self):
-        fps = self.fps_text.value()
-        width = self.thread.width
-        height = self.thread.height
-        fourcc = 'mp4v'
-        file_name = f'{sys.path[0]}/{self.ipaddress_menu.currentText()}.avi'
-        
+        if self.record_button.isChecked() and not self.stream_camera_name:
+            # Without a camera name the recordings would land outside every camera folder
+            self.record_button.set_state(False)
+            if self.language_value == 0:
+                QtWidgets.QMessageBox.critical(self, 'Error de Cámara', 'No se seleccionó una cámara')
+            elif self.language_value == 1:
+                QtWidgets.QMessageBox.critical(self, 'Camera Error', 'No camera selected')
+            return
         if self.record_button.isChecked():
-            self.thread.output = cv2.VideoWriter(file_name, cv2.VideoWriter_fourcc(*fourcc), fps, (width, height))
-            self.record_button.text_es = 'Grabando...'
-            self.record_button.text_en = 'Recording...'
+            if self.record_trigger_value == 'motion':
+                # Armed: the motion detector starts and stops the recorder
+                mask = None
+                if self.motion_mask_value:
+                    mask = cv2.imread(self.motion_mask_value, cv2.IMREAD_GRAYSCALE)
+                fps = self.fps_text.value() or 25
+                self.thread.motion = recorder.MotionDetector(threshold=self.motion_threshold_value,
+                    min_area=self.motion_area_value, mask=mask, start_frames=self.motion_start_frames_value,
+                    stop_frames=max(int(self.motion_stop_seconds_value * fps), 1))
+                self.thread.motion_signal.connect(self.on_motion_changed)
+                self.record_button.text_es = 'Vigilando...'
+                self.record_button.text_en = 'Armed...'
+            else:
+                self.start_recording()
+                self.record_button.text_es = 'Grabando...'
+                self.record_button.text_en = 'Recording...'
             self.record_button.language_text(self.language_value)
             self.record_button.set_state(True)
         else:
-            self.thread.output.release()
+            if self.thread.motion is not None:
+                self.thread.motion_signal.disconnect(self.on_motion_changed)
+                self.thread.motion = None
+            self.stop_recording()
             self.record_button.text_es = 'Grabar'
             self.record_button.text_en = 'Record'
             self.record_button.language_text(self.language_value)
             self.record_button.set_state(False)
+
+
+    def on_motion_changed(self, active: bool):
+        if not self.record_button.isChecked():
+            return
+        if active:
+            self.start_recording()
+            self.record_button.text_es = 'Grabando...'
+            self.record_button.text_en = 'Recording...'
+        else:
+            self.stop_recording()
+            self.record_button.text_es = 'Vigilando...'
+            self.record_button.text_en = 'Armed...'
+        self.record_button.language_text(self.language_value)
+
+
+    def start_recording(self):
+        if self.recorder is not None or not self.stream_camera_name:
+            return
+        camera_name = self.stream_camera_name
+        camera_folder = f'{self.record_root_value}/{camera_name}'
+        prefix = f'{camera_folder}/{camera_name}'
+
+        os.makedirs(camera_folder, exist_ok=True)
+        if self.uses_remux():
+            # ffmpeg only copies packets from now on, the pre-event frames go to an encoded lead-in segment
+            frames = self.thread.drain_pre_event()
+            if frames:
+                lead_in = recorder.write_lead_in(prefix, frames, self.thread.pre_event.fps)
+                self.closing_threads.append(lead_in)
+                lead_in.finished.connect(lambda thread=lead_in: self.closing_threads.remove(thread))
+            # Packets are copied as they arrive, no decoding or encoding
+            self.recorder = recorder.RemuxRecorder(self.thread.source, prefix,
+                segment_seconds=self.segment_seconds_value)
+            self.recorder.start()
+            self.remux_timer.start()
+        else:
+            self.start_encoder(prefix)
+
+
+    def uses_remux(self) -> bool:
+        """Motion-triggered recordings are always encoded, ffmpeg would lose its startup time after each trigger"""
+        return (self.record_mode_value == 'remux' and self.record_trigger_value == 'manual'
+            and recorder.remux_available())
+
+
+    def start_encoder(self, prefix: str):
+        # 0 is the camera's unlimited FPS, the writer needs a real rate
+        fps = self.fps_text.value() or 25
+        width = self.thread.width
+        height = self.thread.height
+        fourcc = 'mp4v'
+        self.recorder = recorder.RecorderThread(prefix, fps, (width, height), self.thread.release_frame,
+            self.record_queue_value, self.record_overflow_value, fourcc,
+            segment_seconds=self.segment_seconds_value,
+            segment_bytes=int(self.segment_megabytes_value * 1024**2))
+        self.thread.attach_recorder(self.recorder)
+        self.recorder.start()
+
+
+    def check_remux(self):
+        """Falls back to encoding when ffmpeg exits on its own, e.g. on bad credentials or an unsupported stream"""
+        if not isinstance(self.recorder, recorder.RemuxRecorder) or self.recorder.is_running():
+            return
+        self.remux_timer.stop()
+        logger.warning('ffmpeg remux of %s stopped, encoding instead: %s', self.thread.ip_address, self.recorder.error())
+        prefix = self.recorder.prefix
+        self.recorder.stop()
+        # Later recordings of this session skip ffmpeg, it would fail the same way
+        self.record_mode_value = 'encode'
+        self.start_encoder(prefix)
+
+
+    def stop_recording(self):
+        self.remux_timer.stop()
+        if self.recorder is None:
+            return
+        self.thread.attach_recorder(None)
+        self.recorder.stop()
+        self.recorder = None
     
     # -------------------
     # Funciones Controles
     # -------------------
-    def on_left_control_button_clicked(self):
-        self.pan_text.setValue(self.pan_text.value() - 10)
-        username = self.user_value.text()
-        password = self.password_value.text()
-        ip_address = self.ipaddress_value.text()
-        current_ptz = backend.set_PTZ(self.pan_text.value(), self.tilt_text.value(), self.zoom_text.value(), 
-                        ip_address, username, password)
+    def on_left_control_button_pressed(self):
+        self.start_velocity(-self.ptz_speed_value, 0, 0)
 
-        if current_ptz == 'error':
-            if self.language_value == 0:
-                QtWidgets.QMessageBox.critical(self, 'Error de Conexión', 'No hubo conexión con la cámara')
-            elif self.language_value == 1:
-                QtWidgets.QMessageBox.critical(self, 'Connection Error', 'There was no connection to the camera')
 
+    def on_right_control_button_pressed(self):
+        self.start_velocity(self.ptz_speed_value, 0, 0)
 
-    def on_right_control_button_clicked(self):
-        self.pan_text.setValue(self.pan_text.value() + 10)
-        username = self.user_value.text()
-        password = self.password_value.text()
-        ip_address = self.ipaddress_value.text()
-        current_ptz = backend.set_PTZ(self.pan_text.value(), self.tilt_text.value(), self.zoom_text.value(), 
-                        ip_address, username, password)
 
-        if current_ptz == 'error':
-            if self.language_value == 0:
-                QtWidgets.QMessageBox.critical(self, 'Error de Conexión', 'No hubo conexión con la cámara')
-            elif self.language_value == 1:
-                QtWidgets.QMessageBox.critical(self, 'Connection Error', 'There was no connection to the camera')
+    def on_up_control_button_pressed(self):
+        self.start_velocity(0, self.ptz_speed_value, 0)
 
 
-    def on_up_control_button_clicked(self):
-        self.tilt_text.setValue(self.tilt_text.value() + 10)
-        username = self.user_value.text()
-        password = self.password_value.text()
-        ip_address = self.ipaddress_value.text()
-        current_ptz = backend.set_PTZ(self.pan_text.value(), self.tilt_text.value(), self.zoom_text.value(), 
-                        ip_address, username, password)
+    def on_down_control_button_pressed(self):
+        self.start_velocity(0, -self.ptz_speed_value, 0)
 
-        if current_ptz == 'error':
-            if self.language_value == 0:
-                QtWidgets.QMessageBox.critical(self, 'Error de Conexión', 'No hubo conexión con la cámara')
-            elif self.language_value == 1:
-                QtWidgets.QMessageBox.critical(self, 'Connection Error', 'There was no connection to the camera')
 
+    def on_zoomIn_control_button_pressed(self):
+        self.start_velocity(0, 0, self.ptz_speed_value)
 
-    def on_down_control_button_clicked(self):
-        self.tilt_text.setValue(self.tilt_text.value() - 10)
-        username = self.user_value.text()
-        password = self.password_value.text()
-        ip_address = self.ipaddress_value.text()
-        current_ptz = backend.set_PTZ(self.pan_text.value(), self.tilt_text.value(), self.zoom_text.value(), 
-                        ip_address, username, password)
 
-        if current_ptz == 'error':
-            if self.language_value == 0:
-                QtWidgets.QMessageBox.critical(self, 'Error de Conexión', 'No hubo conexión con la cámara')
-            elif self.language_value == 1:
-                QtWidgets.QMessageBox.critical(self, 'Connection Error', 'There was no connection to the camera')
+    def on_zoomOut_control_button_pressed(self):
+        self.start_velocity(0, 0, -self.ptz_speed_value)
+
+
+    def on_control_button_released(self):
+        self.velocity_timer.stop()
+        pan_speed, tilt_speed, zoom_speed = self.velocity
+        self.velocity = (0, 0, 0)
+        # The stop refreshes the position fields once the camera has halted
+        if pan_speed or tilt_speed:
+            self.ptz_worker.pan_tilt_velocity(0, 0, refresh=True)
+        if zoom_speed:
+            self.ptz_worker.zoom_velocity(0, refresh=True)
+
+
+    def start_velocity(self, pan_speed: int, tilt_speed: int, zoom_speed: int):
+        self.velocity = (pan_speed, tilt_speed, zoom_speed)
+        self.send_velocity()
+        self.velocity_timer.start()
+
+
+    def send_velocity(self):
+        pan_speed, tilt_speed, zoom_speed = self.velocity
+        if pan_speed or tilt_speed:
+            self.ptz_worker.pan_tilt_velocity(pan_speed, tilt_speed)
+        if zoom_speed:
+            self.ptz_worker.zoom_velocity(zoom_speed)
 
     # ------------------
     # Funciones Posición
     # ------------------
-    def on_zoom_slider_sliderMoved(self):
-        self.zoom_text.setValue(self.zoom_slider.value())
+    def on_zoom_slider_sliderMoved(self, value: int):
+        self.zoom_text.setValue(value)
+        self.zoom_limiter.submit(value)
 
 
     def on_zoom_slider_sliderReleased(self):
-        username = self.user_value.text()
-        password = self.password_value.text()
-        ip_address = self.ipaddress_value.text()
-        current_ptz = backend.set_PTZ(self.pan_text.value(), self.tilt_text.value(), self.zoom_text.value(), 
-                        ip_address, username, password)
+        self.zoom_text.setValue(self.zoom_slider.value())
+        self.zoom_limiter.flush(self.zoom_slider.value())
 
-        if current_ptz == 'error':
-            if self.language_value == 0:
-                QtWidgets.QMessageBox.critical(self, 'Error de Conexión', 'No hubo conexión con la cámara')
-            elif self.language_value == 1:
-                QtWidgets.QMessageBox.critical(self, 'Connection Error', 'There was no connection to the camera')
+
+    def send_zoom(self, zoom: int):
+        self.ptz_worker.zoom_to(zoom)
 
 
     def on_getPTZ_button_clicked(self):
-        username = self.user_value.text()
-        password = self.password_value.text()
-        ip_address = self.ipaddress_value.text()
-        current_ptz = backend.get_PTZ(ip_address, username, password)
+        self.ptz_worker.query_position()
 
-        if current_ptz != 'error':
-            self.pan_text.setValue(int(current_ptz['pan']))
-            self.tilt_text.setValue(int(current_ptz['tilt']))
-            self.zoom_text.setValue(int(current_ptz['zoom']))
-            self.zoom_slider.setValue(int(current_ptz['zoom']))
-        else:
-            if self.language_value == 0:
-                QtWidgets.QMessageBox.critical(self, 'Error de Conexión', 'No hubo conexión con la cámara')
-            elif self.language_value == 1:
-                QtWidgets.QMessageBox.critical(self, 'Connection Error', 'There was no connection to the camera')
 
     def on_setPTZ_button_clicked(self):
-        username = self.user_value.text()
-        password = self.password_value.text()
-        ip_address = self.ipaddress_value.text()
-        current_ptz = backend.set_PTZ(self.pan_text.value(), self.tilt_text.value(), self.zoom_text.value(), 
-                        ip_address, username, password)
+        self.ptz_worker.move(self.pan_text.value(), self.tilt_text.value(), self.zoom_text.value())
+
+
+    def load_presets(self):
+        if self.stream_camera_id is None:
+            # Typed in by hand, only the server presets are available
+            self.on_presets_loaded([])
+            return
+        self.jobs.submit(backend.get_presets_db, self.stream_camera_id, 'ip_cam', 'ecf406MetroidPrime',
+            on_result=self.on_presets_loaded, on_error=self.on_presets_failed)
+
+
+    def on_presets_loaded(self, presets: list):
+        self.presets = {name: (pan, tilt, zoom) for name, pan, tilt, zoom in presets}
+        self.fill_preset_menu()
+
+
+    def on_presets_failed(self, error: Exception):
+        # Server presets stay usable without the database
+        self.presets = {}
+        self.fill_preset_menu()
+
+
+    def fill_preset_menu(self):
+        self.preset_menu.clear()
+        for name in sorted(set(self.presets) | self.server_presets):
+            self.preset_menu.add_item(name)
+        self.preset_menu.setCurrentIndex(-1)
+
+
+    def on_preset_menu_activated(self, index: int):
+        preset_name = self.preset_menu.itemText(index)
+        if preset_name in self.server_presets:
+            self.ptz_worker.goto_preset(preset_name)
+        elif preset_name in self.presets:
+            pan, tilt, zoom = self.presets[preset_name]
+            self.ptz_worker.move(pan, tilt, zoom)
+            self.on_ptz_position({'pan': pan, 'tilt': tilt, 'zoom': zoom})
 
-        if current_ptz == 'error':
+
+    def on_savePreset_button_clicked(self):
+        if self.language_value == 0:
+            preset_name, ok = QtWidgets.QInputDialog.getText(self, 'Guardar Posición', 'Nombre de la posición')
+        elif self.language_value == 1:
+            preset_name, ok = QtWidgets.QInputDialog.getText(self, 'Save Preset', 'Preset name')
+        preset_name = preset_name.strip()
+        if not ok or preset_name == '':
+            return
+
+        position = (self.pan_text.value(), self.tilt_text.value(), self.zoom_text.value())
+        self.jobs.submit(backend.save_preset_db, self.stream_camera_id, preset_name, *position, 'ip_cam', 'ecf406MetroidPrime',
+            on_error=self.on_db_error)
+        if preset_name not in self.presets and preset_name not in self.server_presets:
+            self.preset_menu.add_item(preset_name)
+        self.presets[preset_name] = position
+        self.preset_menu.setCurrentText(preset_name)
+
+
+    def on_image_label_center(self, x: int, y: int, image_width: int, image_height: int):
+        if self.stop_button.isEnabled():
+            self.ptz_worker.center(x, y, image_width, image_height)
+
+
+    def on_image_label_area(self, x: int, y: int, zoom: int, image_width: int, image_height: int):
+        if self.stop_button.isEnabled():
+            self.ptz_worker.area_zoom(x, y, zoom, image_width, image_height)
+
+
+    def on_ptz_position(self, current_ptz: dict):
+        self.pan_text.setValue(int(current_ptz['pan']))
+        self.tilt_text.setValue(int(current_ptz['tilt']))
+        self.zoom_text.setValue(int(current_ptz['zoom']))
+        self.zoom_slider.setValue(int(current_ptz['zoom']))
+
+
+    def on_event_stream_connected(self, connected: bool):
+        """While the camera pushes its position, commands no longer read it back"""
+        self.ptz_worker.refresh_enabled = not connected
+
+
+    def on_ptz_error(self, command: str):
+        # Every queued command fails while the camera is unreachable, show one dialog at a time
+        if self.ptz_error_shown:
+            return
+        self.ptz_error_shown = True
+        try:
             if self.language_value == 0:
                 QtWidgets.QMessageBox.critical(self, 'Error de Conexión', 'No hubo conexión con la cámara')
             elif self.language_value == 1:
                 QtWidgets.QMessageBox.critical(self, 'Connection Error', 'There was no connection to the camera')
+        finally:
+            self.ptz_error_shown = False
 
     # --------------------
     # Funciones Parametros
     # --------------------
     def on_setParameters_button_clicked(self):
-        username = self.user_value.text()
-        password = self.password_value.text()
-        ip_address = self.ipaddress_value.text()
-        current_ptz = backend.set_parameters(self.fps_text.value(), self.compression_spin.value(), 
-                               ip_address, username, password)
+        # Sent from the job pool, the read and the update are two round trips to the camera
+        self.setParameters_button.setEnabled(False)
+        self.jobs.submit(backend.set_parameters, self.fps_text.value(), self.compression_spin.value(),
+            self.thread.ip_address, self.thread.username, self.thread.password,
+            on_result=self.on_parameters_set)
+
 
-        if current_ptz == 'error':
+    def on_parameters_set(self, result: str):
+        self.setParameters_button.setEnabled(self.stop_button.isEnabled())
+        if result == 'error':
             if self.language_value == 0:
                 QtWidgets.QMessageBox.critical(self, 'Error de Conexión', 'No hubo conexión con la cámara')
             elif self.language_value == 1:
@@ -802,6 +1259,7 @@ class App(QWidget):
     # --------------
     def resizeEvent(self, a0: QtGui.QResizeEvent) -> None:
         width = self.geometry().width()
+        height = self.geometry().height()
 
         self.titulo_card.setGeometry(10, 10, width - 20, 50)
         self.idioma_menu.setGeometry(width - 280, 10, 70, 30)
@@ -811,41 +1269,60 @@ class App(QWidget):
         self.aboutQt_button.setGeometry(width - 60, 10, 30, 30)
 
         self.controles_card.setGeometry(width-200, 70, 190, 150)
-        self.posicion_card.setGeometry(width-200, 230, 190, 380)
-        self.parametros_card.setGeometry(width-200, 620, 190, 230)
+        self.posicion_card.setGeometry(width-200, 230, 190, 420)
+        self.parametros_card.setGeometry(width-200, 660, 190, 230)
+
+        self.imagen_card.setGeometry(210, 70, width - 420, height - 120)
+        self.image_label.setGeometry(10, 10, width - 440, height - 140)
+        # The render thread already runs during the handshake, before Stop is enabled
+        if not self.image_label.scales_on_draw and self.render_thread is not None:
+            size, ratio = self.image_label.pixel_size()
+            self.render_thread.set_target_size(size, ratio)
 
         return super().resizeEvent(a0)
 
 
     def closeEvent(self, event):
-        try:
+        # The window may close during the handshake or after a failed one, before every thread exists
+        if self.handshake is not None:
+            self.handshake.result_signal.disconnect()
+            self.handshake.wait()
+            self.handshake = None
+        self.stop_recording()
+        if self.ptz_worker is not None:
+            self.ptz_worker.stop()
+        if self.subscriber is not None:
+            self.subscriber.stop()
+        if self.render_thread is not None:
+            self.render_thread.stop()
+        if self.thread is not None:
             self.thread.stop()
-        except:
-            pass
+        for thread in list(self.closing_threads):
+            thread.wait()
+        self.sweeper.stop()
+        self.inventory_sync.stop()
+        self.jobs.wait()
+        backend.close_storages()
         event.accept()
 
     # ----------------
     # Funciones Imagen
     # ----------------
-    @pyqtSlot(np.ndarray)
-    def update_image(self, cv_img):
-        """Updates the image_label with a new opencv image"""
-        qt_img = self.convert_cv_qt(cv_img)
-        self.image_label.setPixmap(qt_img)
-        if self.record_button.isChecked():
-            self.thread.output.write(cv_img)
-    
-    def convert_cv_qt(self, cv_img):
-        """Convert from an opencv image to QPixmap"""
-        rgb_image = cv2.cvtColor(cv_img, cv2.COLOR_BGR2RGB)
-        h, w, ch = rgb_image.shape
-        bytes_per_line = ch * w
-        convert_to_Qt_format = QtGui.QImage(rgb_image.data, w, h, bytes_per_line, QtGui.QImage.Format.Format_RGB888)
-        p = convert_to_Qt_format.scaled(1280, 720, Qt.AspectRatioMode.KeepAspectRatio)
-        return QPixmap.fromImage(p)
+    @pyqtSlot()
+    def update_image(self):
+        """Updates the image_label with the latest image prepared by the render thread"""
+        item = self.render_thread.mailbox.take()
+        if item is None:
+            return
+        source_size, qt_img = item
+        self.image_label.set_image(qt_img, source_size)
+        if 'first_frame' not in self.startup_timings:
+            self.startup_timings['first_frame'] = time.perf_counter() - self.startup_start
+            self.report_startup_timings()
 
     
 if __name__=="__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
     app = QApplication(sys.argv)
     a = App()
     a.show()
@@ -0,0 +1,134 @@
+from PyQt6.QtCore import pyqtSignal, QAbstractListModel, QModelIndex, Qt, QThread
+
+import json
+import os
+import threading
+
+
+# -----------------
+# Camera List Model
+# -----------------
+class CameraListModel(QAbstractListModel):
+    """Cameras shown by the camera menu, one (id, nombre, ip_camera, username, password) row each.
+    Mutations apply only the row that changed instead of reloading the whole table"""
+    def __init__(self, rows=(), parent=None):
+        super().__init__(parent)
+        self.rows = [tuple(row) for row in rows]
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid() or index.row() >= len(self.rows):
+            return None
+        if role == Qt.ItemDataRole.DisplayRole:
+            return self.rows[index.row()][1]
+        if role == Qt.ItemDataRole.UserRole:
+            return self.rows[index.row()]
+        return None
+
+    def row(self, position: int):
+        """Returns the camera at a menu position, None for -1 or out of range"""
+        if 0 <= position < len(self.rows):
+            return self.rows[position]
+        return None
+
+    def find(self, camera_id) -> int:
+        for position, row in enumerate(self.rows):
+            if row[0] == camera_id:
+                return position
+        return -1
+
+    def reset(self, rows):
+        self.beginResetModel()
+        self.rows = [tuple(row) for row in rows]
+        self.endResetModel()
+
+    def upsert(self, row):
+        """Adds a new camera or replaces the row with the same id"""
+        row = tuple(row)
+        position = self.find(row[0])
+        if position == -1:
+            self.beginInsertRows(QModelIndex(), len(self.rows), len(self.rows))
+            self.rows.append(row)
+            self.endInsertRows()
+        else:
+            self.rows[position] = row
+            index = self.index(position)
+            self.dataChanged.emit(index, index)
+
+    def remove(self, camera_id):
+        position = self.find(camera_id)
+        if position == -1:
+            return
+        self.beginRemoveRows(QModelIndex(), position, position)
+        del self.rows[position]
+        self.endRemoveRows()
+
+    def reconcile(self, rows):
+        """Brings the model in line with rows by id, keeping unchanged rows and the current selection"""
+        rows = [tuple(row) for row in rows]
+        ids = {row[0] for row in rows}
+        for camera_id in [row[0] for row in self.rows if row[0] not in ids]:
+            self.remove(camera_id)
+        for row in rows:
+            position = self.find(row[0])
+            if position == -1 or self.rows[position] != row:
+                self.upsert(row)
+
+# ---------------
+# Inventory Cache
+# ---------------
+class InventoryCache:
+    """Copy of the cameras table on disk, so the camera menu is filled before the database answers"""
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self) -> list:
+        try:
+            with open(self.path) as file:
+                return [tuple(row) for row in json.load(file)]
+        except (OSError, ValueError, TypeError):
+            return []
+
+    def save(self, rows):
+        """Rows hold the camera passwords, the file is readable by the owner only"""
+        temporary = f'{self.path}.tmp'
+        try:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            with open(os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'w') as file:
+                json.dump([list(row) for row in rows], file)
+            os.replace(temporary, self.path)
+        except OSError:
+            pass
+
+# --------------
+# Inventory Sync
+# --------------
+class InventorySync(QThread):
+    """Reads the cameras table in the background, retrying every retry_interval seconds until it succeeds"""
+    rows_signal = pyqtSignal(list)
+
+    def __init__(self, load, retry_interval: float = 30):
+        super().__init__()
+        self._stop_event = threading.Event()
+        self.load = load
+        self.retry_interval = retry_interval
+        self.error = None
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                rows = self.load()
+            except Exception as error:
+                self.error = error
+                self._stop_event.wait(self.retry_interval)
+                continue
+            self.error = None
+            self.rows_signal.emit([tuple(row) for row in rows])
+            return
+
+    def stop(self):
+        self._stop_event.set()
+        self.wait()
@@ -0,0 +1,59 @@
+from PyQt6.QtCore import pyqtSignal, QObject, QRunnable, QThreadPool
+
+
+# ----
+# Jobs
+# ----
+class JobSignals(QObject):
+    """Signals of a job, created on the GUI thread so connected slots run there"""
+    result_signal = pyqtSignal(object)
+    error_signal = pyqtSignal(object)
+    finished_signal = pyqtSignal()
+
+
+class Job(QRunnable):
+    """Runs function(*args) on a pool thread and emits its return value or the exception raised"""
+    def __init__(self, function, *args):
+        super().__init__()
+        self.function = function
+        self.args = args
+        self.signals = JobSignals()
+
+    def run(self):
+        try:
+            result = self.function(*self.args)
+        except Exception as error:
+            self.signals.error_signal.emit(error)
+        else:
+            self.signals.result_signal.emit(result)
+        finally:
+            self.signals.finished_signal.emit()
+
+
+class JobRunner(QObject):
+    """Runs blocking work, like database calls, away from the GUI thread on a QThreadPool"""
+    def __init__(self, max_threads: int = 4, parent=None):
+        super().__init__(parent)
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(max_threads)
+        # Jobs are kept alive until their signals have been delivered
+        self._jobs = set()
+
+    def submit(self, function, *args, on_result=None, on_error=None) -> Job:
+        job = Job(function, *args)
+        job.setAutoDelete(False)
+        if on_result is not None:
+            job.signals.result_signal.connect(on_result)
+        if on_error is not None:
+            job.signals.error_signal.connect(on_error)
+        job.signals.finished_signal.connect(lambda: self._jobs.discard(job))
+        self._jobs.add(job)
+        self.pool.start(job)
+        return job
+
+    def pending(self) -> int:
+        return len(self._jobs)
+
+    def wait(self, msecs: int = -1) -> bool:
+        """Blocks until every job has run, used on exit so no write is lost"""
+        return self.pool.waitForDone(msecs)
@@ -0,0 +1,145 @@
+import json
+import os
+import threading
+import time
+
+
+def parse_value(text: str):
+    """Converts a VAPIX parameter value to bool, int or float when it round-trips exactly, else str"""
+    text = text.strip()
+    if text in ('yes', 'no'):
+        return text == 'yes'
+    for kind in (int, float):
+        try:
+            value = kind(text)
+        except ValueError:
+            continue
+        if str(value) == text:
+            return value
+    return text
+
+
+def format_value(value) -> str:
+    if isinstance(value, bool):
+        return 'yes' if value else 'no'
+    return str(value)
+
+
+def parse_group(text: str) -> dict:
+    """Parses a param.cgi list response into {'root.Group.Name': typed value}"""
+    values = {}
+    for line in text.splitlines():
+        if '=' not in line:
+            continue
+        name, value = line.split('=', 1)
+        values[name.strip()] = parse_value(value)
+    return values
+
+
+# ---------------
+# Parameter Cache
+# ---------------
+class ParameterCache:
+    """Parameter groups of each camera, fetched once with param.cgi and served from memory
+    until they are older than ttl seconds. Writes only send the values that changed.
+    The cache is saved to path, so the next launch starts with the last known values"""
+    def __init__(self, path: str = None, ttl: float = 3600):
+        self._lock = threading.Lock()
+        self.path = path
+        self.ttl = ttl
+        # {camera: {group: {'fetched': epoch seconds, 'values': {name: value}}}}
+        self.cameras = {}
+        self.fetches = 0
+        self.load()
+
+    def get(self, client, camera: str, group: str, max_age: float = None) -> dict:
+        """Returns the values of a group, fetching it when missing or stale. Raises on request errors"""
+        max_age = self.ttl if max_age is None else max_age
+        with self._lock:
+            entry = self.cameras.get(camera, {}).get(group)
+            if entry is not None and time.time() - entry['fetched'] < max_age:
+                return dict(entry['values'])
+
+        response = client.post('/axis-cgi/param.cgi', {'action': 'list', 'group': group})
+        response.raise_for_status()
+        values = parse_group(response.text)
+        if not values:
+            raise ValueError(f'Empty parameter group: {group}')
+        self.fetches += 1
+        with self._lock:
+            self.cameras.setdefault(camera, {})[group] = {'fetched': time.time(), 'values': values}
+        self.save()
+        return dict(values)
+
+    def read(self, client, camera: str, group: str, names) -> dict:
+        """Fetches only the named parameters ('root.Group.Name') and refreshes them in the cached group"""
+        response = client.post('/axis-cgi/param.cgi',
+            {'action': 'list', 'group': ','.join(name.removeprefix('root.') for name in names)})
+        response.raise_for_status()
+        values = parse_group(response.text)
+        if not values:
+            raise ValueError(f'Empty parameter list: {", ".join(names)}')
+        self.fetches += 1
+        with self._lock:
+            entry = self.cameras.get(camera, {}).get(group)
+            if entry is not None:
+                entry['values'].update(values)
+        return values
+
+    def update(self, client, camera: str, group: str, values: dict, fresh: bool = False) -> dict:
+        """Writes the values ({'root.Group.Name': value}) that differ from the cached ones, or from
+        the camera when fresh, reading only those parameters. Returns what was sent, an empty dict when nothing changed"""
+        current = self.read(client, camera, group, values) if fresh else self.get(client, camera, group)
+        changes = {name: value for name, value in values.items() if current.get(name) != value}
+        if not changes:
+            return changes
+
+        data = {'action': 'update', 'html': 'no', 'timestamp': int(time.time())}
+        for name, value in changes.items():
+            data[name.removeprefix('root.')] = format_value(value)
+        try:
+            response = client.post('/axis-cgi/param.cgi', data)
+            response.raise_for_status()
+            if 'Error' in response.text:
+                raise ValueError(response.text.strip())
+        except:
+            # The camera may have applied part of the update, read it again next time
+            self.invalidate(camera, group)
+            raise
+        with self._lock:
+            entry = self.cameras.get(camera, {}).get(group)
+            if entry is not None:
+                entry['values'].update(changes)
+        self.save()
+        return changes
+
+    def invalidate(self, camera: str, group: str = None):
+        with self._lock:
+            if group is None:
+                self.cameras.pop(camera, None)
+            else:
+                self.cameras.get(camera, {}).pop(group, None)
+        self.save()
+
+    def load(self):
+        if self.path is None:
+            return
+        try:
+            with open(self.path) as file:
+                self.cameras = json.load(file)
+        except (OSError, ValueError):
+            self.cameras = {}
+
+    def save(self):
+        if self.path is None:
+            return
+        with self._lock:
+            content = json.dumps(self.cameras, indent=1)
+        # Written aside and renamed, so a crash never leaves a truncated cache
+        temporary = f'{self.path}.tmp'
+        try:
+            with open(temporary, 'w') as file:
+                file.write(content)
+            os.replace(temporary, self.path)
+        except OSError:
+            pass
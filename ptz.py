@@ -0,0 +1,137 @@
+from PyQt6.QtCore import pyqtSignal, QObject, QThread, QTimer
+
+import threading
+
+import backend
+
+
+# ----------
+# PTZ Worker
+# ----------
+class PTZWorker(QThread):
+    """Sends PTZ commands to the camera away from the GUI thread.
+    Only the newest pending command of each channel is kept: a new move replaces the move
+    still waiting, but does not discard a pending position query"""
+    done_signal = pyqtSignal(str)
+    error_signal = pyqtSignal(str)
+    position_signal = pyqtSignal(dict)
+
+    def __init__(self, ipaddress: str, username: str, password: str):
+        super().__init__()
+        self._run_flag = True
+        self._condition = threading.Condition()
+        self._pending = {}
+        self.ipaddress = ipaddress
+        self.username = username
+        self.password = password
+        self.replaced = 0
+        # Turned off while an event subscriber pushes the position
+        self.refresh_enabled = True
+
+    def run(self):
+        while True:
+            with self._condition:
+                while not self._pending and self._run_flag:
+                    self._condition.wait()
+                if not self._pending:
+                    break
+                # Oldest channel first
+                channel = next(iter(self._pending))
+                name, function, args, refresh = self._pending.pop(channel)
+
+            result = function(*args, self.ipaddress, self.username, self.password)
+            if result == 'error':
+                self.error_signal.emit(name)
+                continue
+            if isinstance(result, dict):
+                self.position_signal.emit(result)
+            self.done_signal.emit(name)
+            if refresh and self.refresh_enabled:
+                self.refresh_position()
+
+    def stop(self):
+        """Sends the pending commands, so a final stop is never lost, and waits for thread to finish"""
+        with self._condition:
+            self._run_flag = False
+            self._condition.notify()
+        self.wait()
+
+    def submit(self, name: str, function, *args, channel: str = 'aim', refresh: bool = False):
+        """Queues function(*args, ipaddress, username, password), replacing the pending command of the channel"""
+        with self._condition:
+            if channel in self._pending:
+                self.replaced += 1
+            self._pending[channel] = (name, function, args, refresh)
+            self._condition.notify()
+
+    def move(self, pan, tilt, zoom):
+        self.submit('move', backend.set_PTZ, pan, tilt, zoom)
+
+    def zoom_to(self, zoom):
+        # Own channel, so an absolute zoom never replaces a pending pan/tilt stop
+        self.submit('zoom', backend.set_zoom, zoom, channel='zoom_to')
+
+    def goto_preset(self, preset_name):
+        self.submit('preset', backend.goto_server_preset, preset_name, refresh=True)
+
+    def center(self, x, y, image_width, image_height):
+        self.submit('center', backend.center_PTZ, x, y, image_width, image_height, refresh=True)
+
+    def area_zoom(self, x, y, zoom, image_width, image_height):
+        self.submit('area_zoom', backend.area_zoom, x, y, zoom, image_width, image_height, refresh=True)
+
+    def pan_tilt_velocity(self, pan_speed, tilt_speed, refresh=False):
+        self.submit('pan_tilt_velocity', backend.continuous_pan_tilt, pan_speed, tilt_speed, refresh=refresh)
+
+    def zoom_velocity(self, zoom_speed, refresh=False):
+        # Separate channel, so a pan/tilt speed never replaces a pending zoom speed
+        self.submit('zoom_velocity', backend.continuous_zoom, zoom_speed, channel='zoom', refresh=refresh)
+
+    def query_position(self):
+        self.submit('position', backend.get_PTZ, channel='query')
+
+    def refresh_position(self):
+        position = backend.get_PTZ(self.ipaddress, self.username, self.password)
+        if position == 'error':
+            self.error_signal.emit('position')
+        else:
+            self.position_signal.emit(position)
+
+
+# ------------
+# Rate Limiter
+# ------------
+class RateLimiter(QObject):
+    """Forwards values to callback at most rate times per second, keeping only the latest one.
+    The first value goes out at once, later ones wait for the end of the interval"""
+    def __init__(self, callback, rate: float, parent=None):
+        super().__init__(parent)
+        self.callback = callback
+        self._pending = None
+        self._last = None
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(int(1000 / rate))
+        self.timer.timeout.connect(self._on_timeout)
+
+    def submit(self, value):
+        if self.timer.isActive():
+            self._pending = value
+            return
+        self._send(value)
+
+    def flush(self, value):
+        """Sends the final value right away, even within the interval"""
+        self.timer.stop()
+        self._pending = None
+        self._send(value)
+
+    def _on_timeout(self):
+        value, self._pending = self._pending, None
+        if value is not None and value != self._last:
+            self._send(value)
+
+    def _send(self, value):
+        self._last = value
+        self.callback(value)
+        self.timer.start()
@@ -0,0 +1,365 @@
+from PyQt6.QtCore import QThread
+
+import collections
+import math
+import os
+import queue
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import cv2
+
+OVERFLOW_POLICIES = ('block', 'drop_oldest', 'drop_newest')
+RECORDING_EXTENSIONS = ('.avi', '.mkv', '.mp4')
+# Suffix segment_name and the segment muxer add to the camera name
+RECORDING_NAME = r'_\d{8}_\d{6}(_\d+)?(' + '|'.join(re.escape(extension) for extension in RECORDING_EXTENSIONS) + ')'
+
+
+def segment_name(prefix: str, extension: str) -> str:
+    """Returns a timestamped file name for a new segment, e.g. prefix_20240101_120000.avi"""
+    file_name = f'{prefix}_{time.strftime("%Y%m%d_%H%M%S")}.{extension}'
+    index = 1
+    while os.path.exists(file_name):
+        file_name = f'{prefix}_{time.strftime("%Y%m%d_%H%M%S")}_{index}.{extension}'
+        index += 1
+    return file_name
+
+
+# ---------------
+# Recorder Thread
+# ---------------
+class RecorderThread(QThread):
+    """Encodes frames with cv2.VideoWriter on its own thread, fed from a bounded queue.
+    A new timestamped segment is started every segment_seconds or segment_bytes (0 disables each)"""
+    def __init__(self, prefix: str, fps: float, size: tuple, release_frame=None,
+                 queue_size: int = 64, overflow: str = 'drop_oldest', fourcc: str = 'mp4v',
+                 extension: str = 'avi', segment_seconds: float = 0, segment_bytes: int = 0):
+        super().__init__()
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f'Unknown overflow policy: {overflow}')
+        self._run_flag = True
+        self._lock = threading.Lock()
+        self.prefix = prefix
+        self.extension = extension
+        self.segment_seconds = segment_seconds
+        self.segment_bytes = segment_bytes
+        self.file_name = None
+        self.fps = fps
+        self.size = size
+        self.fourcc = fourcc
+        self.overflow = overflow
+        self.release_frame = release_frame
+        self.queue = queue.Queue(maxsize=queue_size)
+        # Pre-event frames written at the start of the first segment
+        self.preroll = []
+        # Counters
+        self.written = 0
+        self.dropped = 0
+        # Set when a segment could not be opened, its frames are discarded
+        self.error = None
+
+    def run(self):
+        output = self.open_segment()
+        segment_start = time.monotonic()
+        segment_frames = 0
+        # Checking the file size on every frame is needless, once per second of video is enough
+        size_check = max(int(self.fps), 1)
+        for frame in self.preroll:
+            if (frame.shape[1], frame.shape[0]) != self.size:
+                frame = cv2.resize(frame, self.size, interpolation=cv2.INTER_LINEAR)
+            output.write(frame)
+            self.written += 1
+        self.preroll = []
+        while self._run_flag or not self.queue.empty():
+            try:
+                frame = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            rotate = self.segment_seconds and time.monotonic() - segment_start >= self.segment_seconds
+            if not rotate and self.segment_bytes and segment_frames and segment_frames % size_check == 0:
+                try:
+                    rotate = os.path.getsize(self.file_name) >= self.segment_bytes
+                except OSError:
+                    # The writer never created the file
+                    pass
+            if rotate:
+                output.release()
+                output = self.open_segment()
+                segment_start = time.monotonic()
+                segment_frames = 0
+            output.write(frame)
+            self.written += 1
+            segment_frames += 1
+            self._release(frame)
+        output.release()
+
+    def open_segment(self):
+        self.file_name = segment_name(self.prefix, self.extension)
+        output = cv2.VideoWriter(self.file_name, cv2.VideoWriter_fourcc(*self.fourcc), self.fps, self.size)
+        if not output.isOpened():
+            # Writes to a closed writer are ignored, the frames still go back to the pool
+            self.error = f'Could not open {self.file_name}'
+        return output
+
+    def stop(self):
+        """Stops accepting frames, waits until the queue is written and closes the file"""
+        with self._lock:
+            self._run_flag = False
+        self.wait()
+
+    def write(self, frame) -> bool:
+        """Queues a frame following the overflow policy. Returns False if the frame was dropped"""
+        with self._lock:
+            if not self._run_flag:
+                self._release(frame)
+                return False
+            if self.overflow == 'block':
+                self.queue.put(frame)
+                return True
+            try:
+                self.queue.put_nowait(frame)
+                return True
+            except queue.Full:
+                pass
+            self.dropped += 1
+            if self.overflow == 'drop_newest':
+                self._release(frame)
+                return False
+            try:
+                self._release(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            self.queue.put_nowait(frame)
+            return True
+
+    def depth(self) -> int:
+        return self.queue.qsize()
+
+    def _release(self, frame):
+        if self.release_frame is not None:
+            self.release_frame(frame)
+
+def write_lead_in(prefix: str, frames: list, fps: float, fourcc: str = 'mp4v') -> RecorderThread:
+    """Encodes frames already taken from the ring into their own segment, on a thread that
+    ends once they are written. Used before a remuxed recording, which cannot include them"""
+    output = RecorderThread(prefix, fps, (frames[0].shape[1], frames[0].shape[0]), fourcc=fourcc)
+    output.preroll = frames
+    # Accepts no further frames, run() returns after the preroll
+    output._run_flag = False
+    output.start()
+    return output
+
+# ----------------
+# Pre-Event Buffer
+# ----------------
+class PreEventBuffer:
+    """Ring of the last seconds of video kept under a fixed memory ceiling.
+    Frames are downscaled when seconds * fps full-size frames would not fit in max_bytes"""
+    def __init__(self, seconds: float, fps: float, max_bytes: int):
+        self.fps = fps
+        self.capacity = max(int(seconds * fps), 1)
+        self.max_bytes = max_bytes
+        self.frames = collections.deque(maxlen=self.capacity)
+        self.size = None
+        self.source_shape = None
+
+    def push(self, frame):
+        if frame.shape != self.source_shape:
+            self.frames.clear()
+            self.source_shape = frame.shape
+            scale = min(1.0, math.sqrt(self.max_bytes / (self.capacity * frame.nbytes)))
+            self.size = (max(int(frame.shape[1] * scale), 2), max(int(frame.shape[0] * scale), 2))
+        if self.size == (frame.shape[1], frame.shape[0]):
+            self.frames.append(frame.copy())
+        else:
+            self.frames.append(cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA))
+
+    def drain(self) -> list:
+        """Returns the buffered frames, oldest first, and empties the ring"""
+        frames = list(self.frames)
+        self.frames.clear()
+        return frames
+
+# ---------------
+# Motion Detector
+# ---------------
+class MotionDetector:
+    """Frame differencing against a running background on a tiny grayscale copy of each frame.
+    Motion starts after start_frames changed frames in a row and stops after stop_frames still ones"""
+    def __init__(self, size: tuple = (64, 36), threshold: int = 25, min_area: float = 0.01,
+                 mask=None, start_frames: int = 3, stop_frames: int = 75, learning_rate: float = 0.05):
+        self.size = size
+        self.threshold = threshold
+        self.min_area = min_area
+        self.start_frames = start_frames
+        self.stop_frames = stop_frames
+        self.learning_rate = learning_rate
+        self.mask = None
+        self.mask_area = size[0] * size[1]
+        if mask is not None:
+            # Non-zero pixels of the mask are watched, the rest is ignored
+            self.mask = cv2.resize(mask, size, interpolation=cv2.INTER_NEAREST)
+            self.mask = cv2.threshold(self.mask, 0, 255, cv2.THRESH_BINARY)[1]
+            self.mask_area = max(cv2.countNonZero(self.mask), 1)
+        self.background = None
+        self.active = False
+        self.level = 0.0
+        self._moving = 0
+        self._still = 0
+
+    def update(self, frame) -> bool:
+        """Analyses a BGR frame and returns whether motion is active after hysteresis"""
+        # Nearest neighbour on the full frame is far cheaper than area averaging, the blur removes the aliasing
+        small = cv2.resize(frame, self.size, interpolation=cv2.INTER_NEAREST)
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        gray = cv2.GaussianBlur(gray, (3, 3), 0)
+        if self.background is None:
+            self.background = gray.astype('float32')
+            return self.active
+
+        difference = cv2.absdiff(gray, cv2.convertScaleAbs(self.background))
+        changed = cv2.threshold(difference, self.threshold, 255, cv2.THRESH_BINARY)[1]
+        if self.mask is not None:
+            changed = cv2.bitwise_and(changed, self.mask)
+        self.level = cv2.countNonZero(changed) / self.mask_area
+        cv2.accumulateWeighted(gray, self.background, self.learning_rate)
+
+        if self.level >= self.min_area:
+            self._moving += 1
+            self._still = 0
+        else:
+            self._still += 1
+            self._moving = 0
+        if not self.active and self._moving >= self.start_frames:
+            self.active = True
+        elif self.active and self._still >= self.stop_frames:
+            self.active = False
+        return self.active
+
+# --------------
+# Remux Recorder
+# --------------
+class RemuxRecorder:
+    """Copies the compressed stream packets into a container with ffmpeg, without decoding.
+    Segments rotate every segment_seconds through ffmpeg's segment muxer (0 writes a single file)"""
+    def __init__(self, source: str, prefix: str, ffmpeg: str = 'ffmpeg', segment_seconds: float = 0):
+        self.source = source
+        self.prefix = prefix
+        self.ffmpeg = ffmpeg
+        self.segment_seconds = segment_seconds
+        self.process = None
+        self.log = None
+
+    def start(self):
+        command = [self.ffmpeg, '-hide_banner', '-loglevel', 'error', '-y',
+            '-i', self.source, '-map', '0:v', '-c', 'copy']
+        if self.segment_seconds:
+            command += ['-f', 'segment', '-segment_time', str(self.segment_seconds), '-segment_format', 'matroska',
+                '-reset_timestamps', '1', '-strftime', '1', f'{self.prefix}_%Y%m%d_%H%M%S.mkv']
+        else:
+            command += [segment_name(self.prefix, 'mkv')]
+        # A file instead of a pipe, nobody reads stderr while ffmpeg runs
+        self.log = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL, stderr=self.log)
+
+    def stop(self):
+        """Asks ffmpeg to finish the file and waits for it to exit"""
+        if self.process is None:
+            return
+        try:
+            self.process.communicate(b'q', timeout=5)
+        except (subprocess.TimeoutExpired, OSError, ValueError):
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self.process = None
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+    def is_running(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def error(self) -> str:
+        """Returns the last lines ffmpeg wrote to stderr"""
+        if self.log is None:
+            return ''
+        self.log.seek(0)
+        return self.log.read()[-2048:].decode(errors='replace').strip()
+
+
+def remux_available(ffmpeg: str = 'ffmpeg') -> bool:
+    return shutil.which(ffmpeg) is not None
+
+
+# -----------------
+# Retention Sweeper
+# -----------------
+class RetentionSweeper(QThread):
+    """Deletes the oldest recordings under root once the disk quota or the maximum age is reached.
+    Only files named by segment_name or the segment muxer, root/<camera>/<camera>_YYYYmmdd_HHMMSS*,
+    are touched. The newest file of each folder is kept, since it may still be being written"""
+    def __init__(self, root: str, quota_bytes: int = 0, max_age_seconds: float = 0, interval: float = 60):
+        super().__init__()
+        self._stop_event = threading.Event()
+        self.root = root
+        self.quota_bytes = quota_bytes
+        self.max_age_seconds = max_age_seconds
+        self.interval = interval
+        self.deleted = 0
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.sweep()
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.wait()
+
+    def sweep(self):
+        files = []
+        total = 0
+        try:
+            cameras = [entry for entry in os.scandir(self.root) if entry.is_dir(follow_symlinks=False)]
+        except OSError:
+            cameras = []
+        for camera in cameras:
+            pattern = re.compile(re.escape(camera.name) + RECORDING_NAME)
+            try:
+                names = os.listdir(camera.path)
+            except OSError:
+                continue
+            recordings = []
+            for name in names:
+                if not pattern.fullmatch(name):
+                    continue
+                path = os.path.join(camera.path, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                recordings.append((stat.st_mtime, stat.st_size, path))
+            recordings.sort()
+            total += sum(size for _, size, _ in recordings)
+            files.extend(recordings[:-1])
+        files.sort()
+
+        now = time.time()
+        for mtime, size, path in files:
+            expired = self.max_age_seconds and now - mtime > self.max_age_seconds
+            over_quota = self.quota_bytes and total > self.quota_bytes
+            if not expired and not over_quota:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            self.deleted += 1
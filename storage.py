@@ -0,0 +1,270 @@
+import abc
+import contextlib
+import sqlite3
+import threading
+
+try:
+    import psycopg2
+    import psycopg2.extensions
+    import psycopg2.pool
+except ImportError:
+    psycopg2 = None
+
+STORAGES = ('postgres', 'sqlite')
+
+
+# -------
+# Storage
+# -------
+class Storage(abc.ABC):
+    """Camera and preset persistence. Camera rows are (id, nombre, ip_camera, username, password),
+    camera_data is the dict filled by the camera dialog"""
+    @abc.abstractmethod
+    def create(self) -> list:
+        """Creates the tables if needed and returns every camera"""
+
+    @abc.abstractmethod
+    def add_camera(self, camera_data: dict):
+        """Returns the inserted camera row"""
+
+    @abc.abstractmethod
+    def get_camera(self, camera_name: str) -> list:
+        """Returns the rows of the camera with that name"""
+
+    @abc.abstractmethod
+    def edit_camera(self, camera_id, camera_data: dict):
+        """Returns the updated camera row, None if the camera no longer exists"""
+
+    @abc.abstractmethod
+    def delete_camera(self, camera_name: str) -> list:
+        """Returns the ids of the deleted cameras"""
+
+    @abc.abstractmethod
+    def get_presets(self, camera_id) -> list:
+        """Returns (nombre, pan, tilt, zoom) rows ordered by name"""
+
+    @abc.abstractmethod
+    def save_preset(self, camera_id, preset_name: str, pan: float, tilt: float, zoom: float):
+        """Stores a preset, replacing the position of an existing one with the same name"""
+
+    def close(self):
+        pass
+
+
+def camera_values(camera_data: dict) -> tuple:
+    return (camera_data['name'], camera_data['ip'], camera_data['username'], camera_data['password'])
+
+
+# ----------------
+# Postgres Storage
+# ----------------
+# Statements prepared once per connection, parameters are $1, $2, ...
+POSTGRES_STATEMENTS = {
+    'get_cameras': 'SELECT * FROM cameras',
+    'get_camera': 'SELECT * FROM cameras WHERE nombre = $1',
+    'add_camera': 'INSERT INTO cameras (nombre, ip_camera, username, password) VALUES ($1, $2, $3, $4) RETURNING *',
+    'edit_camera': 'UPDATE cameras SET (nombre, ip_camera, username, password) = ($1, $2, $3, $4) WHERE id = $5 RETURNING *',
+    'delete_camera': 'DELETE FROM cameras WHERE nombre = $1 RETURNING id',
+    'get_presets': 'SELECT nombre, pan, tilt, zoom FROM ptz_presets WHERE camera_id = $1 ORDER BY nombre',
+    'save_preset': """INSERT INTO ptz_presets (camera_id, nombre, pan, tilt, zoom) VALUES ($1, $2, $3, $4, $5)
+                    ON CONFLICT (camera_id, nombre) DO UPDATE
+                    SET pan = EXCLUDED.pan, tilt = EXCLUDED.tilt, zoom = EXCLUDED.zoom""",
+}
+
+
+if psycopg2 is not None:
+    class PreparedConnection(psycopg2.extensions.connection):
+        """Connection that prepares each statement of POSTGRES_STATEMENTS on the server the first
+        time it runs, later calls only send EXECUTE with the parameters"""
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.prepared = set()
+
+        def execute_prepared(self, cursor, statement: str, params: tuple = ()):
+            if statement not in self.prepared:
+                cursor.execute(f'PREPARE {statement} AS {POSTGRES_STATEMENTS[statement]}')
+                self.prepared.add(statement)
+            if params:
+                placeholders = ', '.join(['%s'] * len(params))
+                cursor.execute(f'EXECUTE {statement} ({placeholders})', params)
+            else:
+                cursor.execute(f'EXECUTE {statement}')
+
+
+class PostgresStorage(Storage):
+    """Postgres behind a ThreadedConnectionPool of PreparedConnection"""
+    def __init__(self, db_name: str, db_password: str, host: str = 'localhost', port: str = '5432',
+                 user: str = 'postgres', connect_timeout: int = 5, max_connections: int = 8):
+        if psycopg2 is None:
+            raise RuntimeError('psycopg2 is not installed')
+        self.pool = psycopg2.pool.ThreadedConnectionPool(1, max_connections,
+            connection_factory=PreparedConnection, user=user, password=db_password,
+            host=host, port=port, database=db_name, connect_timeout=connect_timeout)
+
+    @contextlib.contextmanager
+    def cursor(self):
+        """Lends a pooled connection, committing on success and rolling back on error"""
+        connection = self.pool.getconn()
+        try:
+            yield connection, connection.cursor()
+            connection.commit()
+        except:
+            if not connection.closed:
+                connection.rollback()
+            raise
+        finally:
+            # A broken connection is discarded instead of going back to the pool
+            self.pool.putconn(connection, close=bool(connection.closed))
+
+    def create(self):
+        with self.cursor() as (connection, cursor):
+            cursor.execute("""CREATE TABLE IF NOT EXISTS cameras (
+                            id serial PRIMARY KEY,
+                            nombre VARCHAR(128) UNIQUE NOT NULL,
+                            ip_camera VARCHAR(15) UNIQUE NOT NULL,
+                            username VARCHAR(128) NOT NULL,
+                            password VARCHAR(128) NOT NULL
+                            )""")
+            cursor.execute("""CREATE TABLE IF NOT EXISTS ptz_presets (
+                            id serial PRIMARY KEY,
+                            camera_id INTEGER NOT NULL REFERENCES cameras(id) ON DELETE CASCADE,
+                            nombre VARCHAR(128) NOT NULL,
+                            pan REAL NOT NULL,
+                            tilt REAL NOT NULL,
+                            zoom REAL NOT NULL,
+                            UNIQUE (camera_id, nombre)
+                            )""")
+            connection.commit()
+            connection.execute_prepared(cursor, 'get_cameras')
+            return cursor.fetchall()
+
+    def add_camera(self, camera_data):
+        with self.cursor() as (connection, cursor):
+            connection.execute_prepared(cursor, 'add_camera', camera_values(camera_data))
+            return cursor.fetchone()
+
+    def get_camera(self, camera_name):
+        with self.cursor() as (connection, cursor):
+            connection.execute_prepared(cursor, 'get_camera', (camera_name,))
+            return cursor.fetchall()
+
+    def edit_camera(self, camera_id, camera_data):
+        with self.cursor() as (connection, cursor):
+            connection.execute_prepared(cursor, 'edit_camera', camera_values(camera_data) + (camera_id,))
+            return cursor.fetchone()
+
+    def delete_camera(self, camera_name):
+        with self.cursor() as (connection, cursor):
+            connection.execute_prepared(cursor, 'delete_camera', (camera_name,))
+            return [row[0] for row in cursor.fetchall()]
+
+    def get_presets(self, camera_id):
+        with self.cursor() as (connection, cursor):
+            connection.execute_prepared(cursor, 'get_presets', (camera_id,))
+            return cursor.fetchall()
+
+    def save_preset(self, camera_id, preset_name, pan, tilt, zoom):
+        with self.cursor() as (connection, cursor):
+            connection.execute_prepared(cursor, 'save_preset', (camera_id, preset_name, pan, tilt, zoom))
+
+    def close(self):
+        self.pool.closeall()
+
+
+# --------------
+# SQLite Storage
+# --------------
+class SQLiteStorage(Storage):
+    """Embedded database file in WAL mode, readers never wait for the writer.
+    Each thread gets its own connection, and sqlite3 caches the compiled statements of each one"""
+    def __init__(self, path: str, timeout: float = 5):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+
+    @contextlib.contextmanager
+    def cursor(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute('PRAGMA foreign_keys=ON')
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        with connection:
+            yield connection.cursor()
+
+    def create(self):
+        with self.cursor() as cursor:
+            cursor.execute("""CREATE TABLE IF NOT EXISTS cameras (
+                            id INTEGER PRIMARY KEY AUTOINCREMENT,
+                            nombre VARCHAR(128) UNIQUE NOT NULL,
+                            ip_camera VARCHAR(15) UNIQUE NOT NULL,
+                            username VARCHAR(128) NOT NULL,
+                            password VARCHAR(128) NOT NULL
+                            )""")
+            cursor.execute("""CREATE TABLE IF NOT EXISTS ptz_presets (
+                            id INTEGER PRIMARY KEY AUTOINCREMENT,
+                            camera_id INTEGER NOT NULL REFERENCES cameras(id) ON DELETE CASCADE,
+                            nombre VARCHAR(128) NOT NULL,
+                            pan REAL NOT NULL,
+                            tilt REAL NOT NULL,
+                            zoom REAL NOT NULL,
+                            UNIQUE (camera_id, nombre)
+                            )""")
+            cursor.execute('SELECT * FROM cameras')
+            return cursor.fetchall()
+
+    def add_camera(self, camera_data):
+        with self.cursor() as cursor:
+            cursor.execute('INSERT INTO cameras (nombre, ip_camera, username, password) VALUES (?, ?, ?, ?) RETURNING *',
+                camera_values(camera_data))
+            return cursor.fetchone()
+
+    def get_camera(self, camera_name):
+        with self.cursor() as cursor:
+            cursor.execute('SELECT * FROM cameras WHERE nombre = ?', (camera_name,))
+            return cursor.fetchall()
+
+    def edit_camera(self, camera_id, camera_data):
+        with self.cursor() as cursor:
+            cursor.execute("""UPDATE cameras SET nombre = ?, ip_camera = ?, username = ?, password = ?
+                            WHERE id = ? RETURNING *""", camera_values(camera_data) + (camera_id,))
+            return cursor.fetchone()
+
+    def delete_camera(self, camera_name):
+        with self.cursor() as cursor:
+            cursor.execute('DELETE FROM cameras WHERE nombre = ? RETURNING id', (camera_name,))
+            return [row[0] for row in cursor.fetchall()]
+
+    def get_presets(self, camera_id):
+        with self.cursor() as cursor:
+            cursor.execute('SELECT nombre, pan, tilt, zoom FROM ptz_presets WHERE camera_id = ? ORDER BY nombre',
+                (camera_id,))
+            return cursor.fetchall()
+
+    def save_preset(self, camera_id, preset_name, pan, tilt, zoom):
+        with self.cursor() as cursor:
+            cursor.execute("""INSERT INTO ptz_presets (camera_id, nombre, pan, tilt, zoom) VALUES (?, ?, ?, ?, ?)
+                            ON CONFLICT (camera_id, nombre) DO UPDATE
+                            SET pan = excluded.pan, tilt = excluded.tilt, zoom = excluded.zoom""",
+                (camera_id, preset_name, pan, tilt, zoom))
+
+    def close(self):
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections.clear()
+
+
+def open_storage(kind: str, db_name: str, db_password: str = None, path: str = None) -> Storage:
+    """Returns the storage selected in settings, path is the SQLite file (default db_name.sqlite3)"""
+    if kind == 'postgres':
+        return PostgresStorage(db_name, db_password)
+    if kind == 'sqlite':
+        return SQLiteStorage(path or f'{db_name}.sqlite3')
+    raise ValueError(f'Unknown storage: {kind}')
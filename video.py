@@ -0,0 +1,329 @@
+from PyQt6 import QtGui, QtWidgets, QtCore
+from PyQt6.QtGui import QPixmap
+from PyQt6.QtCore import pyqtSignal, Qt, QThread
+
+import threading
+import numpy as np
+
+try:
+    from PyQt6.QtOpenGLWidgets import QOpenGLWidget
+except ImportError:
+    QOpenGLWidget = None
+
+
+# -------------
+# Frame Mailbox
+# -------------
+class FrameMailbox:
+    """Single-slot buffer between threads where the latest frame wins"""
+    def __init__(self, on_drop=None):
+        self._condition = threading.Condition()
+        self._frame = None
+        self._on_drop = on_drop
+        self.received = 0
+        self.dropped = 0
+
+    def put(self, frame) -> bool:
+        """Stores a frame, overwriting the pending one. Returns True if the slot was empty"""
+        with self._condition:
+            old_frame = self._frame
+            self._frame = frame
+            self.received += 1
+            if old_frame is not None:
+                self.dropped += 1
+            self._condition.notify()
+        if old_frame is not None and self._on_drop is not None:
+            self._on_drop(old_frame)
+        return old_frame is None
+
+    def take(self):
+        """Returns the pending frame and empties the slot, or None if there is no frame"""
+        with self._condition:
+            frame = self._frame
+            self._frame = None
+        return frame
+
+    def wait(self, timeout: float = None):
+        """Blocks until a frame is available or the timeout expires, then takes it"""
+        with self._condition:
+            if self._frame is None:
+                self._condition.wait(timeout)
+            frame = self._frame
+            self._frame = None
+        return frame
+
+    def clear(self):
+        frame = self.take()
+        if frame is not None and self._on_drop is not None:
+            self._on_drop(frame)
+
+# ----------
+# Frame Pool
+# ----------
+class FramePool:
+    """Fixed set of reusable frame buffers, filled in place by cv2.VideoCapture.read.
+    Buffers are reference counted: every holder calls release() once it is done"""
+    def __init__(self, size: int, shape: tuple, dtype=np.uint8):
+        self._lock = threading.Lock()
+        self._free = [np.empty(shape, dtype) for _ in range(size)]
+        self._refs = {}
+        self.size = size
+        self.shape = shape
+        self.exhausted = 0
+
+    def acquire(self):
+        """Hands out a free buffer, or None when every buffer is in use"""
+        with self._lock:
+            if not self._free:
+                self.exhausted += 1
+                return None
+            buffer = self._free.pop()
+            self._refs[id(buffer)] = [buffer, 1]
+        return buffer
+
+    def retain(self, buffer):
+        """Adds a holder to a buffer that is already handed out"""
+        with self._lock:
+            entry = self._refs.get(id(buffer))
+            if entry is not None and entry[0] is buffer:
+                entry[1] += 1
+
+    def release(self, buffer):
+        """Drops a holder and returns the buffer to the pool when nobody holds it.
+        Arrays that do not belong to the pool are ignored"""
+        if buffer is None:
+            return
+        with self._lock:
+            entry = self._refs.get(id(buffer))
+            if entry is None or entry[0] is not buffer:
+                return
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._refs[id(buffer)]
+                self._free.append(buffer)
+
+    def available(self) -> int:
+        with self._lock:
+            return len(self._free)
+
+# -------------
+# Render Thread
+# -------------
+class RenderThread(QThread):
+    """Converts captured frames into display-ready QImages away from the GUI thread"""
+    image_ready_signal = pyqtSignal()
+
+    def __init__(self, source: FrameMailbox, release_frame, size: tuple = (1280, 720), pixel_ratio: float = 1.0):
+        """size=None keeps the native resolution, for surfaces that scale while drawing"""
+        super().__init__()
+        self._run_flag = True
+        self.source = source
+        self.release_frame = release_frame
+        self.target = (size, pixel_ratio)
+        # Scaled size is only recomputed when the source or target size changes
+        self._fit_key = None
+        self._fit_size = None
+        # Holds ((width, height), image) pairs, the pooled frame goes back as soon as it is converted
+        self.mailbox = FrameMailbox()
+
+    def run(self):
+        while self._run_flag:
+            cv_img = self.source.wait(0.1)
+            if cv_img is None:
+                continue
+            try:
+                qt_img = self.convert_cv_qt(cv_img)
+                source_size = (cv_img.shape[1], cv_img.shape[0])
+            finally:
+                self.release_frame(cv_img)
+            if self.mailbox.put((source_size, qt_img)):
+                self.image_ready_signal.emit()
+        self.mailbox.clear()
+
+    def stop(self):
+        """Sets run flag to False and waits for thread to finish"""
+        self._run_flag = False
+        self.wait()
+
+    def set_target_size(self, size: tuple, pixel_ratio: float = 1.0):
+        """Sets the device-pixel size images are scaled to, safe to call from the GUI thread"""
+        self.target = (size, pixel_ratio)
+
+    def convert_cv_qt(self, cv_img):
+        """Convert from an opencv image to a QImage of the target size"""
+        h, w, ch = cv_img.shape
+        bytes_per_line = ch * w
+        # BGR888 reads the opencv layout directly, no cvtColor needed
+        convert_to_Qt_format = QtGui.QImage(cv_img.data, w, h, bytes_per_line, QtGui.QImage.Format.Format_BGR888)
+        size, pixel_ratio = self.target
+        if size is None:
+            return convert_to_Qt_format.copy()
+        key = (w, h, size)
+        if key != self._fit_key:
+            self._fit_size = QtCore.QSize(w, h).scaled(size[0], size[1], Qt.AspectRatioMode.KeepAspectRatio)
+            self._fit_key = key
+        if self._fit_size == convert_to_Qt_format.size():
+            # Copy so the image does not share the pooled buffer
+            p = convert_to_Qt_format.copy()
+        else:
+            p = convert_to_Qt_format.scaled(self._fit_size)
+        p.setDevicePixelRatio(pixel_ratio)
+        return p
+
+# --------------
+# Video Surfaces
+# --------------
+class VideoLabel(QtWidgets.QLabel):
+    """QLabel surface, receives images already scaled by the render thread"""
+    scales_on_draw = False
+
+    def __init__(self, parent, geometry):
+        super(VideoLabel, self).__init__(parent)
+        x, y, w, h = geometry
+        self.setGeometry(x, y, w, h)
+        self.setFrameStyle(QtWidgets.QFrame.Shape.Box)
+        self.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        self.source_size = None
+
+    def set_image(self, image, source_size: tuple = None):
+        """source_size is the (width, height) of the camera frame the image was scaled from"""
+        self.source_size = source_size or (image.width(), image.height())
+        self.setPixmap(QPixmap.fromImage(image))
+
+    def image_rect(self):
+        """Returns where the image is drawn, in widget coordinates"""
+        pixmap = self.pixmap()
+        if pixmap is None or pixmap.isNull():
+            return None
+        size = pixmap.deviceIndependentSize().toSize()
+        rect = self.contentsRect()
+        x = rect.x() + (rect.width() - size.width()) // 2
+        y = rect.y() + (rect.height() - size.height()) // 2
+        return QtCore.QRect(x, y, size.width(), size.height())
+
+    def pixel_size(self):
+        """Returns the drawable size in device pixels and the device pixel ratio"""
+        ratio = self.devicePixelRatioF()
+        rect = self.contentsRect()
+        return (int(rect.width() * ratio), int(rect.height() * ratio)), ratio
+
+
+if QOpenGLWidget is not None:
+    class VideoGLSurface(QOpenGLWidget):
+        """OpenGL surface, the frame is uploaded as a texture and scaled while drawing"""
+        scales_on_draw = True
+
+        def __init__(self, parent, geometry):
+            super(VideoGLSurface, self).__init__(parent)
+            x, y, w, h = geometry
+            self.setGeometry(x, y, w, h)
+            self.image = None
+            self.source_size = None
+            self._fit_key = None
+            self._fit_rect = None
+
+        def set_image(self, image, source_size: tuple = None):
+            """source_size is the (width, height) of the camera frame the image comes from"""
+            self.image = image
+            self.source_size = source_size or (image.width(), image.height())
+            self.update()
+
+        def image_rect(self):
+            """Returns where the image is drawn, in widget coordinates"""
+            if self.image is None:
+                return None
+            key = (self.image.size(), self.size())
+            if key != self._fit_key:
+                target = self.image.size().scaled(self.size(), Qt.AspectRatioMode.KeepAspectRatio)
+                x = (self.width() - target.width()) // 2
+                y = (self.height() - target.height()) // 2
+                self._fit_rect = QtCore.QRect(x, y, target.width(), target.height())
+                self._fit_key = key
+            return self._fit_rect
+
+        def pixel_size(self):
+            """Returns the drawable size in device pixels and the device pixel ratio"""
+            ratio = self.devicePixelRatioF()
+            return (int(self.width() * ratio), int(self.height() * ratio)), ratio
+
+        def paintGL(self):
+            painter = QtGui.QPainter(self)
+            painter.fillRect(self.rect(), Qt.GlobalColor.black)
+            if self.image is not None:
+                painter.setRenderHint(QtGui.QPainter.RenderHint.SmoothPixmapTransform)
+                painter.drawImage(self.image_rect(), self.image)
+            painter.end()
+
+
+# --------------
+# Aim Controller
+# --------------
+class AimController(QtCore.QObject):
+    """Turns a click on a video surface into a center request and a rubber-band drag into an
+    area zoom request. Positions are mapped through the letterboxing to camera frame pixels"""
+    center_signal = pyqtSignal(int, int, int, int)
+    area_signal = pyqtSignal(int, int, int, int, int)
+
+    def __init__(self, surface, min_drag: int = 8):
+        super().__init__(surface)
+        self.surface = surface
+        self.min_drag = min_drag
+        self.origin = None
+        self.rubber_band = QtWidgets.QRubberBand(QtWidgets.QRubberBand.Shape.Rectangle, surface)
+        surface.installEventFilter(self)
+
+    def eventFilter(self, watched, event):
+        event_type = event.type()
+        if event_type == QtCore.QEvent.Type.MouseButtonPress and event.button() == Qt.MouseButton.LeftButton:
+            self.origin = event.position().toPoint()
+            self.rubber_band.setGeometry(QtCore.QRect(self.origin, QtCore.QSize()))
+            self.rubber_band.show()
+            return True
+        if event_type == QtCore.QEvent.Type.MouseMove and self.origin is not None:
+            self.rubber_band.setGeometry(QtCore.QRect(self.origin, event.position().toPoint()).normalized())
+            return True
+        if event_type == QtCore.QEvent.Type.MouseButtonRelease and self.origin is not None:
+            selection = QtCore.QRect(self.origin, event.position().toPoint()).normalized()
+            self.origin = None
+            self.rubber_band.hide()
+            self.aim(selection)
+            return True
+        return False
+
+    def map_to_source(self, point):
+        """Maps a widget point to camera frame pixels, None when it falls outside the image"""
+        rect = self.surface.image_rect()
+        if rect is None or self.surface.source_size is None or not rect.contains(point):
+            return None
+        width, height = self.surface.source_size
+        x = (point.x() - rect.x()) * width // rect.width()
+        y = (point.y() - rect.y()) * height // rect.height()
+        return x, y
+
+    def aim(self, selection):
+        center = self.map_to_source(selection.center())
+        if center is None:
+            return
+        width, height = self.surface.source_size
+        if selection.width() < self.min_drag and selection.height() < self.min_drag:
+            self.center_signal.emit(center[0], center[1], width, height)
+            return
+        # Zoom so the whole selection fits in the view, 100 means no change
+        rect = self.surface.image_rect()
+        zoom = int(100 * min(rect.width() / max(selection.width(), 1), rect.height() / max(selection.height(), 1)))
+        self.area_signal.emit(center[0], center[1], zoom, width, height)
+
+
+def opengl_available() -> bool:
+    """Whether an OpenGL context can actually be created, the module may import without a driver"""
+    if QOpenGLWidget is None:
+        return False
+    context = QtGui.QOpenGLContext()
+    return context.create() and context.isValid()
+
+
+def create_surface(parent, geometry: tuple, renderer: str):
+    """Returns the video surface selected in settings, falling back to the QLabel one"""
+    if renderer == 'opengl' and opengl_available():
+        return VideoGLSurface(parent, geometry)
+    return VideoLabel(parent, geometry)